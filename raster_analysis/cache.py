@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent cache of results per geometry, keyed by content.
+
+The key of a result is a hash of the geometry and of everything else that
+determines the result, such as the path and version of the store and the
+requested statistics. Changed geometries or stores therefore simply miss
+the cache. When the cache grows beyond its maximum size, the least
+recently used results are evicted.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger(__name__)
+
+PATH = os.path.join(os.path.expanduser('~'), '.cache', 'raster-analysis')
+SIZE = 1024  # megabytes
+VARIABLES = 500  # keys per query, well below the limit of SQLite
+
+SCHEMA = ('CREATE TABLE IF NOT EXISTS results '
+          '(key TEXT PRIMARY KEY, value TEXT, size INTEGER, accessed REAL)')
+
+
+def get_version(path):
+    """
+    Return text that changes when the store or raster at path changes.
+
+    All files and directories below path are inspected, because raster
+    stores rewrite their chunks in place, deep down in the store.
+    """
+    stats = [os.stat(path)]
+    if os.path.isdir(path):
+        for root, directories, names in os.walk(path):
+            for name in directories + names:
+                stats.append(os.stat(os.path.join(root, name)))
+    return '{}:{}:{}'.format(max(s.st_mtime for s in stats),
+                             sum(s.st_size for s in stats),
+                             len(stats))
+
+
+class Cache(object):
+    """ Results in a SQLite database in a local directory. """
+    def __init__(self, path=PATH, size=SIZE):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.size = int(size * 2 ** 20)
+        self.connection = sqlite3.connect(
+            os.path.join(path, 'cache.sqlite'), timeout=60,
+        )
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+        self.total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM results',
+        ).fetchone()[0]
+
+    def get_key(self, geometry, **kwargs):
+        """
+        Return key for geometry and anything else in kwargs.
+
+        The spatial reference of the geometry is part of the key, because
+        the same coordinates mean something else in another one.
+        """
+        sr = geometry.GetSpatialReference()
+        sha1 = hashlib.sha1(bytes(geometry.ExportToWkb()))
+        sha1.update(('' if sr is None else sr.ExportToWkt()).encode('utf-8'))
+        sha1.update(json.dumps(kwargs, sort_keys=True).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def get_many(self, keys):
+        """ Return dictionary of cached results for any of keys. """
+        keys = list(set(keys))
+        results = {}
+        for start in range(0, len(keys), VARIABLES):
+            selection = keys[start:start + VARIABLES]
+            rows = self.connection.execute(
+                'SELECT key, value FROM results WHERE key IN ({})'.format(
+                    ','.join('?' * len(selection)),
+                ),
+                selection,
+            )
+            results.update((key, json.loads(value)) for key, value in rows)
+        if results:
+            accessed = time.time()
+            self.connection.executemany(
+                'UPDATE results SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key in results],
+            )
+            self.connection.commit()
+        return results
+
+    def set_many(self, results):
+        """
+        Store dictionary of results per key in one transaction, evicting
+        old results if necessary.
+        """
+        accessed = time.time()
+        rows = []
+        for key, value in results.items():
+            text = json.dumps(value)
+            rows.append((key, text, len(text), accessed))
+        if not rows:
+            return
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', rows,
+        )
+        self.connection.commit()
+        self.total += sum(row[2] for row in rows)
+        if self.total > self.size:
+            self.evict()
+
+    def get(self, key):
+        """ Return cached result for key, or None. """
+        return self.get_many([key]).get(key)
+
+    def set(self, key, value):
+        """ Store result for key, evicting old results if necessary. """
+        self.set_many({key: value})
+
+    def evict(self):
+        """ Remove least recently used results until well below size. """
+        total = self.connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM results',
+        ).fetchone()[0]
+        keys = []
+        rows = self.connection.execute(
+            'SELECT key, size FROM results ORDER BY accessed',
+        )
+        for key, size in rows:
+            if total <= self.size * 0.9:
+                break
+            keys.append((key,))
+            total -= size
+        self.connection.executemany('DELETE FROM results WHERE key = ?', keys)
+        self.connection.commit()
+        self.total = total
+        logger.debug('Evicted %s results from cache.', len(keys))
@@ -1,6 +1,17 @@
 # -*- coding: utf-8 -*-
 """
-Add the raster value under the centroid of input geometries to a shapefile.
+Add the values of rasters and raster stores under the centroid of input
+geometries to a shapefile.
+
+Each raster is given as ATTRIBUTE=PATH, for example dem=dem.tif. A raster
+without attribute gets the attribute of the attribute option. Centroids are
+transformed once per distinct spatial reference and converted to pixel
+indices once per distinct geo transform.
+
+Features are sampled in chunks along a Morton curve through their
+centroids, so that consecutive chunks mostly need the raster blocks that
+are already in the block cache. The target is still written in the order
+of the source.
 """
 
 from __future__ import print_function
@@ -9,16 +20,19 @@ from __future__ import absolute_import
 from __future__ import division
 
 import argparse
+import collections
 import logging
+import os
 import sys
 
-from osgeo import gdal_array
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
 import numpy as np
 
+from raster_analysis import cache
 from raster_analysis import common
+from raster_analysis import sampling
 
 gdal.UseExceptions()
 ogr.UseExceptions()
@@ -38,9 +52,10 @@ def get_parser():
         help='Path to shape with source features.',
     )
     parser.add_argument(
-        'raster_path',
-        metavar='STORE',
-        help='Path to gdal raster.',
+        'raster_paths',
+        metavar='RASTER',
+        nargs='+',
+        help='Path to gdal raster or raster store, optionally as NAME=PATH.',
     )
     parser.add_argument(
         'target_path',
@@ -50,72 +65,235 @@ def get_parser():
     parser.add_argument(
         '-a', '--attribute',
         default='value',
-        help='Specify an alternative attribute name instead of "value"',
+        help=('Specify an alternative attribute name instead of "value" '
+              'for a raster without attribute.'),
     )
     parser.add_argument(
         '-p', '--partial',
         help='Partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Amount of parallel processes (default 1).',
+    )
+    parser.add_argument(
+        '-c', '--chunk-size',
+        type=int,
+        default=4096,
+        help='Amount of features sampled at once (default 4096).',
+    )
+    parser.add_argument(
+        '-b', '--block-cache',
+        type=float,
+        default=sampling.BLOCK_CACHE,
+        help=('Raster block cache per process, shared by all rasters, '
+              'in megabytes (default {}).').format(sampling.BLOCK_CACHE),
+    )
+    parser.add_argument(
+        '--cache',
+        default=cache.PATH,
+        dest='cache_path',
+        help='Directory for cached results (default "{}").'.format(
+            cache.PATH,
+        ),
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=float,
+        default=cache.SIZE,
+        help='Maximum cache size in megabytes (default {}).'.format(
+            cache.SIZE,
+        ),
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use cached results.',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume an interrupted run, appending to the target.',
+    )
     return parser
 
 
-class GeoTransform(tuple):
+class Worker(object):
+    """ Sample rasters at the centroids of batches of features. """
+    def __init__(self, source_path, sources, block_cache,
+                 cache_path, cache_size):
+        # keep the source, or the layer loses its datasource
+        self.source = common.Source(source_path)
+        self.layer = self.source.layer
+        sr = self.layer.GetSpatialRef()
+        self.samplers = [
+            sampling.get_sampler(path, sr=sr,
+                                 cache_size=block_cache / len(sources))
+            for attribute, path in sources
+        ]
+
+        # group samplers by spatial reference and geo transform
+        self.transformations = collections.OrderedDict()
+        self.groups = collections.OrderedDict()
+        for index, sampler in enumerate(self.samplers):
+            wkt = '' if sampler.sr is None else sampler.sr.ExportToWkt()
+            if wkt not in self.transformations:
+                self.transformations[wkt] = sampling.get_transformation(
+                    source=sr, target=sampler.sr,
+                )
+            geo_transform = getattr(sampler, 'geo_transform', None)
+            self.groups.setdefault((wkt, geo_transform), []).append(index)
+
+        if cache_path is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(path=cache_path, size=cache_size)
+            self.spec = {'command': 'centroid',
+                         'rasters': [[os.path.abspath(path),
+                                      cache.get_version(path)]
+                                     for attribute, path in sources]}
 
-    def get_centroid_indices(self, geometry):
-        """Return (i1, i2), (j1, j2) image coordinates.
+    def get_counts(self):
+        """ Return total block cache hits and misses. """
+        caches = [sampler.cache for sampler in self.samplers
+                  if hasattr(sampler, 'cache')]
+        return (sum(c.hits for c in caches),
+                sum(c.misses for c in caches))
 
-        :param geometry: ogr geometry.
+    def sample(self, geometries):
+        """ Return list of value lists, one per geometry. """
+        points = [geometry.Centroid().GetPoint_2D() for geometry in geometries]
+        columns = [None] * len(self.samplers)
 
-        Use the inverse of the transformation matrix to calculate
-        image subpixel coordinates from the bounding box of the
-        supplied geometry.
+        # transform once per spatial reference
+        coordinates = {}
+        for wkt, transformation in self.transformations.items():
+            transformed = points
+            if transformation is not None:
+                transformed = transformation.TransformPoints(points)
+            coordinates[wkt] = np.array(transformed, dtype='f8')[:, :2].T
 
-        Geometry and geo transform must be with respect to the same
-        coordinate reference system.
+        # index once per geo transform
+        for (wkt, geo_transform), indices in self.groups.items():
+            x, y = coordinates[wkt]
+            if geo_transform is None:
+                for index in indices:
+                    columns[index] = self.samplers[index].sample(x, y)
+                continue
+            u, v = geo_transform.get_indices(x, y)
+            for index in indices:
+                columns[index] = self.samplers[index].sample_indices(u, v)
+
+        return [list(row) for row in zip(*columns)]
+
+    def __call__(self, fids):
         """
-        # spatial coordinates
-        x, y = geometry.Centroid().GetPoints()[0]
+        Return value lists, block cache hits, block cache misses.
 
-        # inverse transformation
-        p, a, b, q, c, d = self
-        (e, f), (g, h) = np.linalg.inv([(a, b), (c, d)])
+        The hits and misses are counted during this call only.
+        """
+        hits, misses = self.get_counts()
+        geometries = [common.get_geometry(self.layer, fid) for fid in fids]
+        values = [None] * len(fids)
 
-        # apply to envelope corners
-        u = int(e * (x - p) + f * (y - q))
-        v = int(g * (x - p) + h * (y - q))
+        # lookup
+        if self.cache is None:
+            missing = list(range(len(fids)))
+        else:
+            missing = []
+            keys = [self.cache.get_key(geometry, **self.spec)
+                    for geometry in geometries]
+            cached = self.cache.get_many(keys)
+            for index, key in enumerate(keys):
+                if key in cached:
+                    values[index] = cached[key]['values']
+                else:
+                    missing.append(index)
 
-        return u, v
+        # sample the rest in one go
+        if missing:
+            rows = self.sample([geometries[index] for index in missing])
+            for index, row in zip(missing, rows):
+                values[index] = row
+            if self.cache is not None:
+                self.cache.set_many({keys[index]: {'values': values[index]}
+                                     for index in missing})
 
+        total_hits, total_misses = self.get_counts()
+        return values, total_hits - hits, total_misses - misses
 
-def command(source_path, raster_path, target_path, attribute, partial):
+
+def get_sources(raster_paths, attribute):
+    """ Return list of attribute, path tuples for raster arguments. """
+    sources = []
+    for text in raster_paths:
+        name, separator, path = text.partition('=')
+        if separator:
+            sources.append((name, path))
+        else:
+            sources.append((attribute, text))
+    return sources
+
+
+def command(source_path, raster_paths, target_path, attribute, partial,
+            jobs, chunk_size, block_cache, cache_path, cache_size, no_cache,
+            resume):
     """ Main """
-    if partial is None:
-        source_features = common.Source(source_path)
-    else:
-        source_features = common.Source(source_path).select(partial)
-
-    raster = gdal.Open(raster_path)
-    geo_transform = GeoTransform(raster.GetGeoTransform())
-    sr = osr.SpatialReference(raster.GetProjection())
-    band = raster.GetRasterBand(1)
-    dtype = gdal_array.flip_code(band.DataType)
-    no_data_value = np.array(band.GetNoDataValue(), dtype).item()
+    sources = get_sources(raster_paths=raster_paths, attribute=attribute)
+    attributes = [name for name, path in sources]
+    if len(set(name.lower() for name in attributes)) < len(attributes):
+        print('Error: each raster needs its own attribute.')
+        return 1
+
+    source = common.Source(source_path)
+    fids = source.get_fids(partial)
 
     # prepare statistics gathering
     target = common.Target(
         path=target_path,
         template_path=source_path,
-        attributes=[attribute],
+        attributes=attributes,
+        resume=resume,
+    )
+    checkpoint = common.Checkpoint(path=target_path,
+                                   datasets=[target.dataset],
+                                   resume=resume)
+    fids = [fid for fid in fids if fid not in checkpoint]
+
+    # sample per chunk of spatially close features
+    ordered = sampling.sort_fids(layer=source.layer, fids=fids)
+    chunks = [ordered[i:i + chunk_size]
+              for i in range(0, len(ordered), chunk_size)]
+    results = common.process(
+        factory=Worker,
+        kwargs={'source_path': source_path,
+                'sources': sources,
+                'block_cache': block_cache,
+                'cache_path': None if no_cache else cache_path,
+                'cache_size': cache_size},
+        items=chunks,
+        jobs=jobs,
     )
 
-    for source_feature in source_features:
-        geometry = source_feature.geometry()
-        geometry.TransformTo(sr)
-        xoff, yoff = geo_transform.get_centroid_indices(geometry)
-        value = band.ReadAsArray(xoff, yoff, 1, 1).item()
-        attributes = {attribute: None if value == no_data_value else value}
-        target.append(geometry=geometry,
-                      attributes=attributes)
+    # write in source order as soon as possible
+    pending = {}
+    hits = misses = 0
+    remaining = iter(fids)
+    fid = next(remaining, None)
+    for chunk in common.progress(chunks, total=len(chunks)):
+        values, chunk_hits, chunk_misses = next(results)
+        pending.update(zip(chunk, values))
+        hits += chunk_hits
+        misses += chunk_misses
+        while fid in pending:
+            target.append(geometry=common.get_geometry(source.layer, fid),
+                          attributes=dict(zip(attributes, pending.pop(fid))))
+            checkpoint.add(fid)
+            fid = next(remaining, None)
+    checkpoint.commit()
+    logger.info('Block cache: %s hits, %s misses.', hits, misses)
     return 0
 
 
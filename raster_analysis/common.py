@@ -6,16 +6,398 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import division
 
+import json
+import math
+import multiprocessing
 import os
+import time
+import traceback
 
 from osgeo import gdal
 from osgeo import ogr
 from osgeo import osr
+import numpy as np
 
 gdal.UseExceptions()
 ogr.UseExceptions()
 osr.UseExceptions()
 
+DRIVER_OGR_MEMORY = ogr.GetDriverByName(str('Memory'))
+DRIVER_GDAL_MEM = gdal.GetDriverByName(str('mem'))
+POLYGON = 'POLYGON (({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))'
+CELLSIZE = 0.5  # ahn2 resolution, for stores that do not have a geo transform
+INTERVAL = 60  # seconds between checkpoints
+
+
+def rasterize(layer, geo_transform, width, height, data_type, **kwargs):
+    """ Return array of layer rasterized at geo_transform. """
+    dataset = DRIVER_GDAL_MEM.Create('', width, height, 1, data_type)
+    dataset.SetGeoTransform(geo_transform)
+    gdal.RasterizeLayer(dataset, [1], layer, **kwargs)
+    return dataset.ReadAsArray()
+
+
+def get_mask(geometry, geo_transform, width, height):
+    """ Return boolean array that is True where geometry is. """
+    datasource = DRIVER_OGR_MEMORY.CreateDataSource('')
+    sr = geometry.GetSpatialReference()
+    layer = datasource.CreateLayer(str('geometry'), sr)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    return rasterize(layer=layer,
+                     geo_transform=geo_transform,
+                     width=width,
+                     height=height,
+                     data_type=gdal.GDT_Byte,
+                     burn_values=[1]).astype(bool)
+
+
+def get_windows(envelope, width, height, cells):
+    """
+    Return list of extent, width, height tuples.
+
+    The windows divide a grid of width by height pixels over envelope
+    into parts of at most cells pixels, following the same pixel grid.
+    """
+    x1, x2, y1, y2 = envelope
+    a, d = (x2 - x1) / width, (y1 - y2) / height
+    w = max(1, min(width, int(math.sqrt(cells))))
+    h = max(1, min(height, cells // w))
+    windows = []
+    for v1 in range(0, height, h):
+        v2 = min(height, v1 + h)
+        for u1 in range(0, width, w):
+            u2 = min(width, u1 + w)
+            extent = x1 + a * u1, y2 + d * v2, x1 + a * u2, y2 + d * v1
+            windows.append((extent, u2 - u1, v2 - v1))
+    return windows
+
+
+def get_fetch(geometry, request):
+    """
+    Return function that returns values, size tuple for a window.
+
+    The windows are those of get_windows and request is called with a
+    rectangle geometry, width and height to get data for a window. Only
+    values with data that are within geometry are returned.
+    """
+    sr = geometry.GetSpatialReference()
+
+    def fetch(window):
+        """ Return values, size tuple for window. """
+        (x1, y1, x2, y2), width, height = window
+        wkt = POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
+        rectangle = ogr.CreateGeometryFromWkt(wkt, sr)
+        if not rectangle.Intersects(geometry):
+            return np.array([]), width * height
+
+        data = request(rectangle, width, height)
+        values = data['values'].reshape(height, width)
+        geo_transform = x1, (x2 - x1) / width, 0, y2, 0, (y1 - y2) / height
+        mask = get_mask(geometry=geometry,
+                        geo_transform=geo_transform,
+                        width=width,
+                        height=height)
+        active = values[mask & (values != data['no_data_value'])]
+        return active, values.size
+
+    return fetch
+
+
+class Sizer(object):
+    """
+    Size store requests according to the resolution of a store.
+
+    With a tolerance, large geometries are requested at power-of-two
+    multiples of the native cellsize, so that the store can read from a
+    coarser pyramid level. The cellsize then grows up to the tolerance
+    times the largest dimension of the envelope of the geometry.
+    """
+    def __init__(self, store, tolerance=None):
+        geo_transform = getattr(store, 'geo_transform', None)
+        if geo_transform is None:
+            self.origin = 0, 0
+            self.cellsize = CELLSIZE, CELLSIZE
+        else:
+            p, a, b, q, c, d = geo_transform
+            self.origin = p, q
+            self.cellsize = abs(a), abs(d)
+        self.tolerance = tolerance
+
+    def get_cellsize(self, envelope):
+        """ Return cellsize tuple to use for envelope. """
+        a, d = self.cellsize
+        if self.tolerance is None:
+            return a, d
+        x1, x2, y1, y2 = envelope
+        limit = self.tolerance * max(x2 - x1, y2 - y1)
+        factor = 1
+        while max(a, d) * factor * 2 <= limit:
+            factor *= 2
+        return a * factor, d * factor
+
+    def get_size(self, envelope):
+        """ Return width, height tuple for envelope. """
+        x1, x2, y1, y2 = envelope
+        a, d = self.get_cellsize(envelope)
+        width = int(math.ceil((x2 - x1) / a))
+        height = int(math.ceil((y2 - y1) / d))
+        return width, height
+
+    def get_kwargs(self, geometry):
+        """ Return get_data kwargs for geometry. """
+        name = geometry.GetGeometryName()
+        if name == 'POINT':
+            return {}
+        if name == 'LINESTRING':
+            cellsize = min(self.get_cellsize(geometry.GetEnvelope()))
+            size = int(math.ceil(geometry.Length() / cellsize))
+            return {'size': size}
+        if name == 'POLYGON':
+            width, height = self.get_size(geometry.GetEnvelope())
+            return {'width': width, 'height': height}
+
+    def get_window(self, envelope):
+        """
+        Return x1, y2, width, height of the window covering envelope that
+        is aligned to the native grid of the store.
+        """
+        x1, x2, y1, y2 = envelope
+        p, q = self.origin
+        a, d = self.cellsize
+        u1 = int(math.floor((x1 - p) / a))
+        u2 = int(math.ceil((x2 - p) / a))
+        v1 = int(math.floor((q - y2) / d))
+        v2 = int(math.ceil((q - y1) / d))
+        return p + u1 * a, q - v1 * d, u2 - u1, v2 - v1
+
+
+def progress(iterable, total):
+    """ Return generator of items from iterable, reporting progress. """
+    gdal.TermProgress_nocb(0)
+    for count, item in enumerate(iterable, 1):
+        yield item
+        gdal.TermProgress_nocb(count / total)
+
+
+# worker of the current process, when processing with multiple jobs
+_worker = None
+
+
+def _initialize(factory, kwargs):
+    """ Create the worker of a pool process. """
+    global _worker
+    _worker = factory(**kwargs)
+
+
+def _call(item):
+    return _worker(item)
+
+
+def process(factory, kwargs, items, jobs=1, chunk_size=1):
+    """
+    Return generator of results of a worker for items, in order of items.
+
+    :param factory: callable that returns a worker for kwargs
+    :param kwargs: keyword arguments for factory
+    :param items: picklable items to be passed to the worker
+    :param jobs: amount of worker processes
+    :param chunk_size: amount of items sent to a process at a time
+
+    The worker is created once per process, so that expensive resources
+    like stores and datasets are opened only once per process. Chunks of
+    items are handed out to whichever process is idle.
+    """
+    if jobs == 1:
+        worker = factory(**kwargs)
+        for item in items:
+            yield worker(item)
+        return
+
+    pool = multiprocessing.Pool(processes=jobs,
+                                initializer=_initialize,
+                                initargs=(factory, kwargs))
+    try:
+        for result in pool.imap(_call, items, chunk_size):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _serve(connection, factory, kwargs, memory_limit):
+    """ Run a worker on items received over connection, until None. """
+    if memory_limit is not None:
+        import resource  # not available on windows
+        limit = int(memory_limit * 2 ** 20)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    worker = factory(**kwargs)
+    for item in iter(connection.recv, None):
+        try:
+            result = True, worker(item)
+        except Exception:
+            result = False, traceback.format_exc()
+        connection.send(result)
+
+
+def _wait(connections, timeout):
+    """ Return connections that have something to receive. """
+    try:
+        from multiprocessing.connection import wait
+    except ImportError:
+        # python 2, where this only works on posix
+        import select
+        return select.select(connections, [], [], timeout)[0]
+    return wait(connections, timeout)
+
+
+class Slot(object):
+    """ A worker process that handles one item at a time. """
+    def __init__(self, factory, kwargs, memory_limit):
+        self.connection, connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_serve, args=(connection, factory, kwargs, memory_limit),
+        )
+        self.process.daemon = True
+        self.process.start()
+        connection.close()
+        self.tasks = 0
+        self.index = None
+        self.started = None
+
+    def submit(self, index, item):
+        """ Send item to the process. """
+        self.connection.send(item)
+        self.index = index
+        self.started = time.time()
+        self.tasks += 1
+
+    def stop(self):
+        """ Terminate the process. """
+        self.process.terminate()
+        self.process.join()
+        self.connection.close()
+
+
+def supervise(factory, kwargs, items, jobs=1,
+              timeout=None, max_tasks=None, memory_limit=None):
+    """
+    Return generator of (ok, result) tuples for items, in order of items.
+
+    :param factory: callable that returns a worker for kwargs
+    :param kwargs: keyword arguments for factory
+    :param items: picklable items to be passed to the worker
+    :param jobs: amount of worker processes
+    :param timeout: seconds an item may take
+    :param max_tasks: amount of items after which a process is replaced
+    :param memory_limit: megabytes of address space per process
+
+    Unlike process, each item is sent to a process of its own choosing and
+    watched separately. An item that raises, takes longer than timeout or
+    crashes its process yields ok False with the reason as result, and a
+    crashed or timed out process is replaced by a fresh one, so that the
+    other processes keep going.
+    """
+    if all([jobs == 1, timeout is None,
+            max_tasks is None, memory_limit is None]):
+        worker = factory(**kwargs)
+        for item in items:
+            try:
+                yield True, worker(item)
+            except Exception:
+                yield False, traceback.format_exc()
+        return
+
+    queue = enumerate(items)
+    slots = [None] * jobs
+    results = {}
+    current = 0
+    exhausted = False
+    try:
+        while True:
+            # hand out items to idle processes
+            for number, slot in enumerate(slots):
+                if exhausted:
+                    break
+                if slot is not None and slot.index is not None:
+                    continue
+                if slot is not None and slot.tasks == max_tasks:
+                    slot.stop()
+                    slot = None
+                if slot is None:
+                    slot = slots[number] = Slot(factory=factory,
+                                                kwargs=kwargs,
+                                                memory_limit=memory_limit)
+                try:
+                    index, item = next(queue)
+                except StopIteration:
+                    exhausted = True
+                    break
+                try:
+                    slot.submit(index=index, item=item)
+                except (IOError, OSError):
+                    results[index] = False, 'Worker process died.'
+                    slot.stop()
+                    slots[number] = None
+
+            while current in results:
+                yield results.pop(current)
+                current += 1
+
+            busy = [s for s in slots if s is not None and s.index is not None]
+            if not busy:
+                if exhausted:
+                    break
+                continue
+
+            # wait for the first result or timeout
+            if timeout is None:
+                wait = None
+            else:
+                deadline = min(s.started for s in busy) + timeout
+                wait = max(0, deadline - time.time())
+            connections = [s.connection for s in busy]
+            ready = _wait(connections, wait)
+
+            now = time.time()
+            for slot in busy:
+                number = slots.index(slot)
+                if slot.connection in ready:
+                    try:
+                        results[slot.index] = slot.connection.recv()
+                        slot.index = None
+                        continue
+                    except EOFError:
+                        slot.stop()
+                        reason = 'Worker process crashed (exit code {}).'
+                        results[slot.index] = False, reason.format(
+                            slot.process.exitcode,
+                        )
+                elif timeout is not None and now - slot.started > timeout:
+                    slot.stop()
+                    reason = 'Timed out after {} seconds.'.format(timeout)
+                    results[slot.index] = False, reason
+                else:
+                    continue
+                slots[number] = None
+    finally:
+        for slot in slots:
+            if slot is not None:
+                slot.stop()
+
+
+def get_geometry(layer, fid):
+    """
+    Return a copy of the geometry of a feature of layer.
+
+    Geometries belong to their feature, which is freed as soon as it is no
+    longer referenced, so they can not be used after their feature is gone.
+    """
+    feature = layer[fid]
+    return feature.geometry().Clone()
+
 
 class Source(object):
     """ Wrap a shapefile. """
@@ -24,11 +406,7 @@ class Source(object):
         self.layer = self.dataset[0]
 
     def __iter__(self):
-        total = len(self)
-        gdal.TermProgress_nocb(0)
-        for count, feature in enumerate(self.layer, 1):
-            yield feature
-            gdal.TermProgress_nocb(count / total)
+        return progress(self.layer, total=len(self))
 
     def __len__(self):
         return self.layer.GetFeatureCount()
@@ -40,22 +418,33 @@ class Source(object):
             yield feature
         self.layer.SetSpatialFilter(None)
 
-    def select(self, text):
-        """ Return generator of features for text, e.g. '2/5' """
+    def get_fids(self, text=None):
+        """ Return fids for text, e.g. '2/5', or all fids if text is None. """
+        if text is None:
+            return range(len(self))
         selected, parts = map(int, text.split('/'))
         size = len(self) / parts
         start = int((selected - 1) * size)
         stop = len(self) if selected == parts else int(selected * size)
-        total = stop - start
-        gdal.TermProgress_nocb(0)
-        for count, fid in enumerate(xrange(start, stop), 1):
+        return range(start, stop)
+
+    def select(self, text):
+        """ Return generator of features for text, e.g. '2/5' """
+        fids = self.get_fids(text)
+        for fid in progress(fids, total=len(fids)):
             yield self.layer[fid]
-            gdal.TermProgress_nocb(count / total)
 
 
 class Target(object):
     """ Wrap a shapefile. """
-    def __init__(self, path, template_path, attributes):
+    def __init__(self, path, template_path, attributes, resume=False):
+        if resume and os.path.exists(path):
+            # continue with existing shape
+            self.dataset = ogr.Open(str(path), 1)
+            self.layer = self.dataset[0]
+            self.layer_defn = self.layer.GetLayerDefn()
+            return
+
         # read template
         template_data_source = ogr.Open(template_path)
         template_layer = template_data_source[0]
@@ -91,3 +480,76 @@ class Target(object):
         for key, value in attributes.items():
             feature[str(key)] = value
         self.layer.CreateFeature(feature)
+
+
+class Checkpoint(object):
+    """
+    Record which source fids have been processed into target datasets.
+
+    Each line of the checkpoint file records the feature counts of the
+    target datasets after committing them to disk, together with the source
+    fids that were processed since the previous line. When resuming,
+    features beyond the recorded counts are removed from the targets, so
+    that the targets and the recorded fids are consistent again. Without
+    a checkpoint file nothing is known to be processed, so all features
+    are removed from the targets.
+    """
+    def __init__(self, path, datasets, resume=False):
+        self.path = path + '.checkpoint'
+        self.datasets = datasets
+        self.fids = set()
+        self.pending = []
+        self.last = time.time()
+
+        if not resume:
+            open(self.path, 'w').close()
+            return
+        if not os.path.exists(self.path):
+            self._truncate([0] * len(datasets))
+            open(self.path, 'w').close()
+            return
+
+        counts = [0] * len(datasets)
+        with open(self.path) as checkpoint_file:
+            for line in checkpoint_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break  # interrupted while writing
+                self.fids.update(record['fids'])
+                counts = record['counts']
+        self._truncate(counts)
+
+    def __contains__(self, fid):
+        return fid in self.fids
+
+    def _truncate(self, counts):
+        """ Remove features beyond counts from datasets. """
+        for dataset, count in zip(self.datasets, counts):
+            layer = dataset[0]
+            fids = [feature.GetFID() for feature in layer]
+            for fid in fids[count:]:
+                layer.DeleteFeature(fid)
+            if len(fids) > count:
+                name = layer.GetName()
+                dataset.ExecuteSQL(str('REPACK "{}"'.format(name)))
+
+    def add(self, fid):
+        """ Record fid as processed, committing once in a while. """
+        self.pending.append(fid)
+        if time.time() - self.last > INTERVAL:
+            self.commit()
+
+    def commit(self):
+        """ Commit datasets to disk and record the pending fids. """
+        for dataset in self.datasets:
+            dataset.SyncToDisk()
+        counts = [dataset[0].GetFeatureCount() for dataset in self.datasets]
+        record = {'counts': counts, 'fids': self.pending}
+        with open(self.path, 'a') as checkpoint_file:
+            checkpoint_file.write(json.dumps(record) + '\n')
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        self.fids.update(self.pending)
+        self.pending = []
+        self.last = time.time()
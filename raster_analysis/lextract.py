@@ -5,6 +5,40 @@ Extract layers from a raster store using a geometry. For instructions
 to do this from a 3Di result, have a look at the README:
 
 https://github.com/nens/raster-analysis/blob/master/README.rst
+
+Tiles are fetched from the store by a pool of threads while the main thread
+writes finished tiles to the target in block order. At most queue depth
+tiles are fetched ahead of the writer, which bounds the memory use.
+
+Blocks that lie completely inside the geometry are written as fetched, only
+blocks on the boundary of the geometry are masked.
+
+With a start (and optionally a stop) time, all frames of the period are
+fetched per tile in a single store request and written as the bands of a
+single target.
+
+With the field option, every feature of the layer is extracted into its own
+target in the output directory, named by the value of the field. The
+targets share a global grid of blocks, so that a block that is needed by
+neighbouring features is fetched only once. With the mosaic option, all
+features are extracted into a single target instead.
+
+With the cog option, the targets are written as cloud optimized GeoTIFFs.
+Overviews are downsampled from each tile as it is written, so that the
+final layout only takes a single copy of the target.
+
+With the resume option, existing targets are opened instead of created,
+and only the blocks that are not yet present in the sparse targets are
+fetched. Targets are flushed to disk once in a while during extraction, so
+that an interrupted run loses at most the blocks of the last interval.
+
+With the npy format, targets are written as memory mapped NumPy arrays with
+frames as first axis, with the georeferencing in a JSON file next to it,
+so that they can be opened with numpy.load(path, mmap_mode='r').
+
+With the estimate option, nothing is written. Instead, the amount of tiles,
+pixels and bytes is reported, together with the runtime and memory use
+extrapolated from fetching a random sample of the tiles.
 """
 
 from __future__ import print_function
@@ -12,36 +46,65 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from __future__ import division
 
+from multiprocessing.pool import ThreadPool
 import argparse
 import collections
+import json
 import logging
+import os
+import random
 import sys
+import threading
+import time
+import zlib
 
 from osgeo import gdal_array
 import numpy as np
 
 from raster_store import load
-from raster_store import datasets
 
+from raster_analysis import common
+from raster_analysis import sampling
 from raster_analysis.common import gdal
 from raster_analysis.common import ogr
-from raster_analysis.common import osr
 
 
 DRIVER_OGR_MEMORY = ogr.GetDriverByName(str('Memory'))
-DRIVER_GDAL_MEM = gdal.GetDriverByName(str('mem'))
 DRIVER_GDAL_GTIFF = gdal.GetDriverByName(str('gtiff'))
 POLYGON = 'POLYGON (({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))'
 
+BLOCK_SIZE = 256, 256  # of targets sharing a grid
+RESAMPLING = 'nearest', 'average', 'min', 'max'
+FORMATS = 'gtiff', 'npy'
+SAMPLE = 10  # tiles fetched for an estimate
+
+logger = logging.getLogger(__name__)
+
 # argument defaults
 CELLSIZE = 0.5, 0.5
 TIME = '1970-01-01T00:00:00Z'
 
-Tile = collections.namedtuple('Tile', ['width',
-                                       'height',
-                                       'origin',
-                                       'polygon',
-                                       'geo_transform'])
+
+class Tile(collections.namedtuple('Tile', ['width',
+                                           'height',
+                                           'origin',
+                                           'extent',
+                                           'geo_transform',
+                                           'interior',
+                                           'part'])):
+    """
+    A block of a target dataset.
+
+    The part is the geometry clipped to the block, for blocks that are not
+    completely inside the geometry.
+    """
+    __slots__ = ()
+
+    @property
+    def wkt(self):
+        """ Return wkt of the polygon of the tile. """
+        x1, y1, x2, y2 = self.extent
+        return POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
 
 
 def get_projection(sr):
@@ -53,16 +116,39 @@ def get_projection(sr):
     return '{name}:{code}'.format(name=name, code=code)
 
 
-def create_dataset(geometry, cellsize, fillvalue, dtype, path):
-        """ The big sparse target dateset"""
-        # properties
-        a, b, c, d = cellsize[0], 0.0, 0.0, -cellsize[1]
-        x1, x2, y1, y2 = geometry.GetEnvelope()
-        p, q = a * (x1 // a), d * (y2 // d)
+def get_grid(geometry, cellsize, block_size=None, origin=(0, 0)):
+    """
+    Return geo transform, width, height for geometry.
+
+    With a block size, origin and size are whole blocks of a grid through
+    origin that is shared by all grids with that block size.
+    """
+    a, b, c, d = cellsize[0], 0.0, 0.0, -cellsize[1]
+    w, h = (1, 1) if block_size is None else block_size
+    x1, x2, y1, y2 = geometry.GetEnvelope()
+    x0, y0 = origin
+    p = x0 + a * w * ((x1 - x0) // (a * w))
+    q = y0 + d * h * ((y2 - y0) // (d * h))
+
+    width = -int((p - x2) // (a * w)) * w
+    height = -int((q - y1) // (d * h)) * h
+    return (p, a, b, q, c, d), width, height
+
+
+def create_dataset(geometry, cellsize, fillvalue, dtype, path, bands=1,
+                   block_size=None, origin=(0, 0)):
+        """
+        The big sparse target dateset
 
-        width = -int((p - x2) // a)
-        height = -int((q - y1) // d)
-        geo_transform = p, a, b, q, c, d
+        With a block size, origin and size of the dataset are whole blocks
+        of a grid through origin that is shared by all datasets with that
+        block size.
+        """
+        # properties
+        geo_transform, width, height = get_grid(geometry=geometry,
+                                                cellsize=cellsize,
+                                                block_size=block_size,
+                                                origin=origin)
         projection = geometry.GetSpatialReference().ExportToWkt()
 
         # data type from store, no data value max of that type
@@ -74,76 +160,253 @@ def create_dataset(geometry, cellsize, fillvalue, dtype, path):
                    'BIGTIFF=YES',
                    'SPARSE_OK=TRUE',
                    'COMPRESS=DEFLATE']
+        if block_size is not None:
+            options.extend(['BLOCKXSIZE={}'.format(block_size[0]),
+                            'BLOCKYSIZE={}'.format(block_size[1])])
         dataset = DRIVER_GDAL_GTIFF.Create(
-            path, width, height, 1, data_type, options,
+            path, width, height, bands, data_type, options,
         )
         dataset.SetProjection(projection)
         dataset.SetGeoTransform(geo_transform)
-        dataset.GetRasterBand(1).SetNoDataValue(no_data_value)
+        for i in range(bands):
+            dataset.GetRasterBand(i + 1).SetNoDataValue(no_data_value)
 
         return dataset
 
 
-class Index(object):
+class ArrayBand(object):
+    """ A band of an array dataset, with the GDAL methods used here. """
+    def __init__(self, dataset, index):
+        self.dataset = dataset
+        self.index = index
+
+    def GetBlockSize(self):
+        return list(self.dataset.block_size)
+
+    def GetNoDataValue(self):
+        return self.dataset.no_data_value
+
+    def GetOverviewCount(self):
+        return 0
+
+    def GetMetadataItem(self, key, domain=None):
+        return None
+
+    def ReadAsArray(self, xoff, yoff, width, height):
+        return np.array(self.dataset.array[self.index,
+                                           yoff:yoff + height,
+                                           xoff:xoff + width])
+
+    def WriteArray(self, array, xoff, yoff):
+        height, width = array.shape
+        self.dataset.array[self.index,
+                           yoff:yoff + height,
+                           xoff:xoff + width] = array
+
+
+class ArrayDataset(object):
     """
-    Iterates the indices into the target dataset.
+    A memory mapped .npy array with a JSON file for georeferencing, with
+    the GDAL methods used here.
+
+    The array has frames as first axis and is stored in row-major order,
+    so that windows of it can be read without reading the rest.
     """
-    def __init__(self, dataset, geometry):
-        """
-        Rasterize geometry into target dataset extent to find relevant
-        blocks.
-        """
-        # make a dataset
-        w, h = dataset.GetRasterBand(1).GetBlockSize()
-        p, a, b, q, c, d = dataset.GetGeoTransform()
-        index = DRIVER_GDAL_MEM.Create(
-            '',
-            (dataset.RasterXSize - 1) // w + 1,
-            (dataset.RasterYSize - 1) // h + 1,
-            1,
-            gdal.GDT_Byte,
+    def __init__(self, path):
+        with open(path + '.json') as metadata_file:
+            metadata = json.load(metadata_file)
+        self.array = np.lib.format.open_memmap(path, mode='r+')
+        self.geo_transform = metadata['geo_transform']
+        self.projection = metadata['projection']
+        self.no_data_value = metadata['no_data_value']
+        self.block_size = metadata['block_size']
+        self.RasterCount, self.RasterYSize, self.RasterXSize = self.array.shape
+
+    @classmethod
+    def create(cls, geometry, cellsize, fillvalue, dtype, path, bands=1,
+               block_size=None, origin=(0, 0)):
+        """ Return new array dataset, filled with no data. """
+        if block_size is None:
+            block_size = BLOCK_SIZE
+        geo_transform, width, height = get_grid(geometry=geometry,
+                                                cellsize=cellsize,
+                                                block_size=block_size,
+                                                origin=origin)
+        metadata = {
+            'geo_transform': geo_transform,
+            'projection': geometry.GetSpatialReference().ExportToWkt(),
+            'no_data_value': np.array(fillvalue, dtype).item(),
+            'block_size': list(block_size),
+        }
+        with open(path + '.json', 'w') as metadata_file:
+            json.dump(metadata, metadata_file, indent=2)
+
+        array = np.lib.format.open_memmap(
+            path, mode='w+', dtype=dtype, shape=(bands, height, width),
         )
+        if fillvalue != 0:
+            for i in range(0, height, block_size[1]):
+                array[:, i:i + block_size[1]] = fillvalue
+        array.flush()
+        return cls(path)
+
+    def FlushCache(self):
+        self.array.flush()
+
+    def GetGeoTransform(self):
+        return tuple(self.geo_transform)
+
+    def GetProjection(self):
+        return self.projection
+
+    def GetRasterBand(self, number):
+        return ArrayBand(dataset=self, index=number - 1)
 
-        geo_transform = p, a * w, b * h, q, c * w, d * h
-        index.SetProjection(dataset.GetProjection())
-        index.SetGeoTransform(geo_transform)
-
-        # rasterize where geometry is
-        datasource = DRIVER_OGR_MEMORY.CreateDataSource('')
-        sr = geometry.GetSpatialReference()
-        layer = datasource.CreateLayer(str('geometry'), sr)
-        layer_defn = layer.GetLayerDefn()
-        feature = ogr.Feature(layer_defn)
-        feature.SetGeometry(geometry)
-        layer.CreateFeature(feature)
-        gdal.RasterizeLayer(
-            index,
-            [1],
-            layer,
-            burn_values=[1],
-            options=['all_touched=true'],
+
+def get_block_size(text):
+    """ Return 'auto' or width, height tuple for text like 512 or 512,256. """
+    if text == 'auto':
+        return text
+    try:
+        block_size = tuple(int(part) for part in text.split(','))
+    except ValueError:
+        block_size = ()
+    if len(block_size) == 1:
+        block_size *= 2
+    if len(block_size) != 2 or any(size <= 0 or size % 16
+                                   for size in block_size):
+        raise argparse.ArgumentTypeError(
+            'expected "auto" or multiples of 16 like 512 or 512,256',
         )
+    return block_size
+
+
+def get_layout(store, cellsize, block_size):
+    """
+    Return block size, origin tuple for targets.
+
+    In auto mode, blocks cover a whole amount of store chunks and the grid
+    runs through the store origin, so that each tile request touches as few
+    store chunks as possible. Stores that do not expose their chunking get
+    the default block size.
+    """
+    if block_size != 'auto':
+        return block_size, (0, 0)
 
-        # remember some of this
+    geo_transform = getattr(store, 'geo_transform', None)
+    chunks = getattr(store, 'chunks', getattr(store, 'block_size', None))
+    if geo_transform is None or chunks is None:
+        logger.warning('Store chunking unknown, using default block size.')
+        return BLOCK_SIZE, (0, 0)
+
+    p, a, b, q, c, d = geo_transform
+    block_size = []
+    for chunk, native, target in zip(chunks[-2:][::-1],
+                                     (abs(a), abs(d)),
+                                     cellsize):
+        # smallest amount of chunks that make a valid tiff block
+        for count in range(1, 65):
+            size = count * chunk * native / target
+            if abs(size - round(size)) > 1e-6 or round(size) > 4096:
+                continue
+            if round(size) % 16 == 0:
+                block_size.append(int(round(size)))
+                break
+        else:
+            logger.warning('No block size matches store chunks, '
+                           'using default block size.')
+            return BLOCK_SIZE, (0, 0)
+    return tuple(block_size), (p, q)
+
+
+def get_factors(dataset):
+    """
+    Return overview factors for dataset.
+
+    Overviews are added until the coarsest one fits in a single block, but
+    a factor always divides the block size, so that each overview tile can
+    be computed from a single block of the dataset and the reduced blocks
+    line up in the overview.
+    """
+    w, h = dataset.GetRasterBand(1).GetBlockSize()
+    size = max(dataset.RasterXSize, dataset.RasterYSize)
+    factors = []
+    factor = 1
+    while (size / factor > max(w, h) and
+           w % (2 * factor) == 0 and h % (2 * factor) == 0):
+        factor *= 2
+        factors.append(factor)
+    return factors
+
+
+def downsample(array, factor, no_data_value, resampling):
+    """ Return array with frames as first axis reduced by factor. """
+    count, height, width = array.shape
+    h, w = -(-height // factor), -(-width // factor)
+    if resampling == 'nearest':
+        return array[:, ::factor, ::factor]
+
+    # pad to whole factors and put the pixels of each result pixel last
+    padded = np.full((count, h * factor, w * factor),
+                     no_data_value,
+                     dtype=array.dtype)
+    padded[:, :height, :width] = array
+    grouped = padded.reshape(count, h, factor, w, factor).transpose(
+        0, 1, 3, 2, 4,
+    ).reshape(count, h, w, factor * factor)
+
+    masked = np.ma.masked_equal(grouped, no_data_value)
+    if resampling == 'average':
+        reduced = masked.mean(-1)
+    elif resampling == 'min':
+        reduced = masked.min(-1)
+    else:
+        reduced = masked.max(-1)
+    return reduced.filled(no_data_value).astype(array.dtype)
+
+
+def get_datasource(geometry):
+    """ Return memory datasource with a layer containing geometry. """
+    datasource = DRIVER_OGR_MEMORY.CreateDataSource('')
+    sr = geometry.GetSpatialReference()
+    layer = datasource.CreateLayer(str('geometry'), sr)
+    layer_defn = layer.GetLayerDefn()
+    feature = ogr.Feature(layer_defn)
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+    return datasource
+
+
+class Index(object):
+    """
+    Iterates the tiles of the target dataset that the geometry covers, in
+    Morton order.
+
+    The grid of blocks is divided in quadrants recursively, clipping the
+    geometry to each quadrant on the way down. Quadrants outside the
+    geometry are skipped and quadrants completely inside it yield all
+    their blocks as interior tiles without further geometry operations.
+    """
+    def __init__(self, dataset, geometry):
+        w, h = dataset.GetRasterBand(1).GetBlockSize()
         self.dataset_size = dataset.RasterXSize, dataset.RasterYSize
         self.geo_transform = dataset.GetGeoTransform()
-        self.indices = index.ReadAsArray().nonzero()
         self.block_size = w, h
-        self.sr = sr
+        self.grid_size = ((dataset.RasterXSize - 1) // w + 1,
+                          (dataset.RasterYSize - 1) // h + 1)
+        self.geometry = geometry
+        self.sr = geometry.GetSpatialReference()
 
-    def __len__(self):
-        return len(self.indices[0])
+        # blocks per side of the root quadrant
+        self.size = 1
+        while self.size < max(self.grid_size):
+            self.size *= 2
 
-    def _get_indices(self, serial):
-        """ Return indices into dataset. """
+    def _get_indices(self, i1, j1, i2, j2):
+        """ Return indices into dataset for a range of blocks. """
         w, h = self.block_size
         W, H = self.dataset_size
-        y, x = self.indices[0][serial].item(), self.indices[1][serial].item()
-        x1 = w * x
-        y1 = h * y
-        x2 = min(W, (x + 1) * w)
-        y2 = min(H, (y + 1) * h)
-        return x1, y1, x2, y2
+        return w * i1, h * j1, min(W, w * i2), min(H, h * j2)
 
     def _get_extent(self, indices):
         """ Convert indices to extent. """
@@ -167,41 +430,408 @@ class Index(object):
         p, a, b, q, c, d = self.geo_transform
         return x1, a, b, y2, c, d
 
+    def _get_tile(self, i, j, part=None):
+        """ Return tile for block at column i and row j. """
+        u1, v1, u2, v2 = indices = self._get_indices(i, j, i + 1, j + 1)
+        extent = self._get_extent(indices)
+        return Tile(width=u2 - u1,
+                    height=v2 - v1,
+                    origin=(u1, v1),
+                    extent=extent,
+                    geo_transform=self._get_geo_transform(extent),
+                    interior=part is None,
+                    part=part)
+
+    def _get_quadrants(self, i, j, size):
+        """ Return quadrants of a quadrant of size blocks, in Morton order. """
+        half = size // 2
+        W, H = self.grid_size
+        return [(i + di, j + dj, half)
+                for dj in (0, half) for di in (0, half)
+                if i + di < W and j + dj < H]
+
+    def _iter_interior(self, i, j, size):
+        """ Return generator of interior tiles in quadrant. """
+        if size == 1:
+            yield self._get_tile(i, j)
+            return
+        for quadrant in self._get_quadrants(i, j, size):
+            for tile in self._iter_interior(*quadrant):
+                yield tile
+
+    def _iter_quadrant(self, i, j, size, geometry):
+        """ Return generator of tiles in quadrant covered by geometry. """
+        indices = self._get_indices(i, j, i + size, j + size)
+        rectangle = self._get_polygon(self._get_extent(indices))
+        part = geometry.Intersection(rectangle)
+        area = part.Area()
+        if area == 0:
+            return
+        if area >= rectangle.Area() * (1 - 1e-9):
+            for tile in self._iter_interior(i, j, size):
+                yield tile
+            return
+        if size == 1:
+            yield self._get_tile(i, j, part=part)
+            return
+        for quadrant in self._get_quadrants(i, j, size):
+            for tile in self._iter_quadrant(*quadrant, geometry=part):
+                yield tile
+
     def __iter__(self):
-        for serial in range(len(self)):
-            x1, y1, x2, y2 = indices = self._get_indices(serial)
-            width, height, origin = x2 - x1, y2 - y1, (x1, y1)
-            extent = self._get_extent(indices)
-            polygon = self._get_polygon(extent)
-            geo_transform = self._get_geo_transform(extent)
-            yield Tile(width=width,
-                       height=height,
-                       origin=origin,
-                       polygon=polygon,
-                       geo_transform=geo_transform)
-
-
-def burn(dataset, geometry, value):
-    """ Burn value where geometry is into dataset. """
-    sr = geometry.GetSpatialReference()
+        return self._iter_quadrant(0, 0, self.size, geometry=self.geometry)
+
+    def get_fraction(self, tile):
+        """
+        Return fraction of the grid traversed up to and including tile.
+
+        The quadrants are traversed in Morton order, so the Morton code of
+        the block of tile tells how far along the traversal is, without
+        having to count the tiles up front.
+        """
+        w, h = self.block_size
+        u, v = tile.origin
+        code = sampling.get_morton(np.array([u // w]), np.array([v // h]))
+        return (code[0].item() + 1) / self.size ** 2
+
+
+class Fetcher(object):
+    """ Fetch tiles clipped to geometries, using a store per thread. """
+    def __init__(self, store_path, sr, time, step,
+                 no_data_value, factors, resampling):
+        self.store_path = store_path
+        self.sr = sr
+        self.time = time
+        self.step = step
+        self.no_data_value = no_data_value
+        self.factors = factors
+        self.resampling = resampling
+        self.local = threading.local()
+
+    def get_mask(self, tile):
+        """ Return boolean array that is True inside the part of tile. """
+        datasource = get_datasource(tile.part)
+        return common.rasterize(layer=datasource[0],
+                                geo_transform=tile.geo_transform,
+                                width=tile.width,
+                                height=tile.height,
+                                data_type=gdal.GDT_Byte,
+                                burn_values=[1]).astype(bool)
+
+    def __call__(self, block):
+        """
+        Return list of number, tile, array, overviews tuples, with frames
+        as first axis of the arrays.
+
+        :param block: list of number, tile tuples of equal extent
+        """
+        if not block:
+            return []
+        store = getattr(self.local, 'store', None)
+        if store is None:
+            store = self.local.store = load(self.store_path)
+
+        # get data
+        tile = block[0][1]
+        kwargs = {'sr': self.sr,
+                  'width': tile.width,
+                  'height': tile.height,
+                  'geom': tile.wkt}
+        kwargs.update(self.time)
+        data = store.get_data(**kwargs)
+        shape = -1, tile.height, tile.width
+        values = data['values'].reshape(shape)[::self.step]
+
+        # set pixels outside geometries to 'no data'
+        no_data_value = np.array(self.no_data_value, values.dtype)
+        results = []
+        for number, tile in block:
+            array = values
+            if not tile.interior:
+                mask = self.get_mask(tile)
+                array = np.where(mask, values, no_data_value)
+            overviews = [downsample(array=array,
+                                    factor=factor,
+                                    no_data_value=no_data_value,
+                                    resampling=self.resampling)
+                         for factor in self.factors[number]]
+            results.append((number, tile, array, overviews))
+        return results
+
+
+def is_written(dataset, tile):
+    """ Return if the block of tile is present in a tiled GeoTIFF. """
+    band = dataset.GetRasterBand(1)
+    w, h = band.GetBlockSize()
+    p1, q1 = tile.origin
+    key = 'BLOCK_OFFSET_{}_{}'.format(p1 // w, q1 // h)
+    return bool(band.GetMetadataItem(str(key), str('TIFF')))
+
+
+def iter_blocks(index, path=None, written=None):
+    """
+    Return generator of blocks of a single index, in the order of the
+    index, without keeping them in memory.
+
+    Tiles that are present in the GeoTIFF at path are appended to written
+    and yield an empty block instead, so that they still pass through the
+    pipeline that releases the semaphore. The GeoTIFF is opened here,
+    because the generator is consumed in another thread than the one that
+    writes the target.
+    """
+    dataset = None if path is None else gdal.Open(str(path))
+    for tile in index:
+        if dataset is not None and is_written(dataset, tile):
+            written.append((0, tile))
+            yield []
+            continue
+        yield [(0, tile)]
+
+
+def track(results, index):
+    """
+    Return generator of results, reporting progress along the index.
+
+    Empty results, of tiles that were already written, leave the progress
+    where it is.
+    """
+    gdal.TermProgress_nocb(0)
+    for result in results:
+        yield result
+        if result:
+            gdal.TermProgress_nocb(index.get_fraction(result[-1][1]))
+    gdal.TermProgress_nocb(1)
+
+
+def get_offset(index, reference):
+    """
+    Return column, row offset in blocks of index in the grid of reference,
+    or None if the grids of index and reference are not the same.
+    """
+    if index.block_size != reference.block_size:
+        return None
+    w, h = index.block_size
+    p1, a1, b1, q1, c1, d1 = reference.geo_transform
+    p2, a2, b2, q2, c2, d2 = index.geo_transform
+    if (a1, b1, c1, d1) != (a2, b2, c2, d2):
+        return None
+    i, j = (p2 - p1) / (a1 * w), (q2 - q1) / (d1 * h)
+    offset = int(round(i)), int(round(j))
+    if abs(i - offset[0]) > 1e-6 or abs(j - offset[1]) > 1e-6:
+        return None
+    return offset
+
+
+def get_blocks(indices, targets=None):
+    """
+    Return list of blocks, each a list of number, tile tuples, and a list
+    of number, tile tuples that are already written.
+
+    Tiles of different indices with the same block in a shared grid end up
+    in the same block, so that they can be fetched together. Blocks are
+    keyed by their integer indices in that grid, and targets that do not
+    share the grid of the first target get blocks of their own. Blocks are
+    ordered along a Morton curve, so that consecutive requests are close in
+    the store. Tiles are only checked for presence if targets are given.
+    """
+    blocks = collections.OrderedDict()
+    written = []
+    for number, index in enumerate(indices):
+        offset = get_offset(index=index, reference=indices[0])
+        group = 0 if offset is not None else number
+        i0, j0 = (0, 0) if offset is None else offset
+        w, h = index.block_size
+        for tile in index:
+            if targets is not None and is_written(targets[number], tile):
+                written.append((number, tile))
+                continue
+            u1, v1 = tile.origin
+            key = group, j0 + v1 // h, i0 + u1 // w
+            blocks.setdefault(key, []).append((number, tile))
+    if not blocks:
+        return [], written
+
+    # order along a Morton curve through each grid
+    keys = list(blocks)
+    groups, rows, columns = np.array(keys).T
+    codes = sampling.get_morton(columns - columns.min(), rows - rows.min())
+    order = np.lexsort((codes, groups)).tolist()
+    return [blocks[keys[k]] for k in order], written
 
-    # put geometry into temporary layer
-    datasource = DRIVER_OGR_MEMORY.CreateDataSource('')
-    layer = datasource.CreateLayer(str(''), sr)
-    layer_defn = layer.GetLayerDefn()
-    feature = ogr.Feature(layer_defn)
-    feature.SetGeometry(geometry)
-    layer.CreateFeature(feature)
 
-    # burn no data
-    burn_values = [value]
-    gdal.RasterizeLayer(dataset, [1], layer, burn_values=burn_values)
+def get_geometries(layer, field, mosaic):
+    """ Return list of name, geometry tuples to extract. """
+    if mosaic:
+        union = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            geometry = feature.geometry()
+            if geometry.GetGeometryType() == ogr.wkbPolygon:
+                union.AddGeometry(geometry)
+            else:
+                for part in geometry:
+                    union.AddGeometry(part)
+        geometry = union.UnionCascaded()
+        geometry.AssignSpatialReference(layer.GetSpatialRef())
+        return [(None, geometry)]
+    if field is None:
+        feature = layer[0]
+        return [(None, feature.geometry().Clone())]
+    return [(feature[str(field)], feature.geometry().Clone())
+            for feature in layer]
 
 
-def command(shape_path, store_path, target_path, cellsize, time):
+class Flusher(object):
     """
-    Prepare and extract the first feature of the first layer.
+    Flush datasets to disk once in a while.
+
+    GeoTIFFs record which blocks are present only when flushed, so without
+    this an interrupted run would have to fetch everything again.
+    """
+    def __init__(self, datasets, interval=common.INTERVAL):
+        self.datasets = datasets
+        self.interval = interval
+        self.last = time.time()
+
+    def __call__(self):
+        """ Flush datasets if the interval has passed. """
+        if time.time() - self.last < self.interval:
+            return
+        for dataset in self.datasets:
+            dataset.FlushCache()
+        self.last = time.time()
+
+
+def get_tiles(blocks, semaphore, stopped):
+    """
+    Return generator of blocks, waiting for room in the queue.
+
+    The generator ends when stopped is set, so that the pool can be
+    terminated while the generator is waiting.
     """
+    for block in blocks:
+        semaphore.acquire()
+        if stopped.is_set():
+            return
+        yield block
+
+
+def get_time(time, start, stop):
+    """ Return time keyword arguments for get_data. """
+    if start is None:
+        return {'start': time}
+    if stop is None:
+        return {'start': start}
+    return {'start': start, 'stop': stop}
+
+
+def count_frames(store, geometry, sr, time, step):
+    """ Return the amount of frames a request for time would return. """
+    x, y = geometry.Centroid().GetPoint_2D()
+    kwargs = {'sr': sr,
+              'width': 1,
+              'height': 1,
+              'geom': POLYGON.format(x1=x, y1=y, x2=x + 1, y2=y + 1)}
+    kwargs.update(time)
+    data = store.get_data(**kwargs)
+    return len(range(0, len(data['values']), step))
+
+
+def write(dataset, tile, array, factors, overviews):
+    """ Write array with frames as first axis and its overviews. """
+    p1, q1 = tile.origin
+    for i in range(len(array)):
+        band = dataset.GetRasterBand(i + 1)
+        band.WriteArray(array[i], p1, q1)
+        for level, factor in enumerate(factors):
+            band.GetOverview(level).WriteArray(
+                overviews[level][i], p1 // factor, q1 // factor,
+            )
+
+
+def finish(source_path, path, block_size):
+    """
+    Copy dataset at source path with its overviews into a cloud optimized
+    GeoTIFF at path, and remove it.
+
+    The dataset must be closed by the caller, so that it is complete on
+    disk and can be removed when the copy is done.
+    """
+    dataset = gdal.Open(str(source_path))
+    w, h = block_size
+    options = ['TILED=YES',
+               'BIGTIFF=IF_SAFER',
+               'COMPRESS=DEFLATE',
+               'COPY_SRC_OVERVIEWS=YES',
+               'BLOCKXSIZE={}'.format(w),
+               'BLOCKYSIZE={}'.format(h)]
+    DRIVER_GDAL_GTIFF.CreateCopy(path, dataset, options=options)
+    dataset = None
+    DRIVER_GDAL_GTIFF.Delete(source_path)
+
+
+def estimate(blocks, fetcher, targets, output_format, threads, queue_depth):
+    """ Print predictions for fetching and writing blocks. """
+    tiles = [tile for block in blocks for number, tile in block]
+    bands = targets[0].RasterCount
+    itemsize = np.dtype(gdal_array.flip_code(
+        targets[0].GetRasterBand(1).DataType,
+    )).itemsize
+    pixels = sum(tile.width * tile.height for tile in tiles) * bands
+
+    # fetch a sample
+    sample = random.sample(blocks, min(SAMPLE, len(blocks)))
+    fetch_time = write_time = 0
+    raw = compressed = peak = 0
+    for block in sample:
+        start = time.time()
+        result = fetcher(block)
+        fetch_time += time.time() - start
+        size = 0
+        for number, tile, array, overviews in result:
+            start = time.time()
+            raw += array.nbytes
+            compressed += len(zlib.compress(array.tobytes(), 6))
+            write_time += time.time() - start
+            size += array.nbytes + sum(o.nbytes for o in overviews)
+        peak = max(peak, size)
+
+    # extrapolate
+    count = max(len(sample), 1)
+    fetch_time *= len(blocks) / count
+    write_time *= len(blocks) / count
+    if output_format == 'npy':
+        output = sum(t.RasterXSize * t.RasterYSize for t in targets)
+        output *= bands * itemsize
+    else:
+        output = pixels * itemsize * (compressed / raw if raw else 1)
+    runtime = max(fetch_time / threads, write_time)
+    memory = (queue_depth + threads) * peak
+
+    print('Blocks to fetch:     {}'.format(len(blocks)))
+    print('Tiles to write:      {}'.format(len(tiles)))
+    print('Pixels:              {}'.format(pixels))
+    print('Uncompressed size:   {:.1f} MB'.format(pixels * itemsize / 2 ** 20))
+    print('Expected output:     {:.1f} MB'.format(output / 2 ** 20))
+    print('Sampled blocks:      {}'.format(len(sample)))
+    print('Expected runtime:    {:.0f} s'.format(runtime))
+    print('Expected tile data:  {:.1f} MB'.format(memory / 2 ** 20))
+
+
+def command(shape_path, store_path, target_path, cellsize, time,
+            start, stop, step, field, mosaic, output_format, block_size,
+            cog, resampling, threads, queue_depth, resume, dry_run):
+    """
+    Prepare and extract the first feature of the first layer, or all
+    features.
+    """
+    if field is not None and mosaic:
+        print('Error: use either field or mosaic, not both.')
+        exit()
+    if output_format == 'npy' and cog:
+        print('Error: cog is only available for the gtiff format.')
+        exit()
+    requested_format = output_format
+
     # process store
     store = load(store_path)
     dtype = np.dtype(store.dtype).type
@@ -211,57 +841,185 @@ def command(shape_path, store_path, target_path, cellsize, time):
     datasource = ogr.Open(shape_path)
     layer = datasource[0]
 
-    feature = layer[0]
-    geometry = feature.geometry()
-    sr = get_projection(geometry.GetSpatialReference())
+    geometries = get_geometries(layer=layer, field=field, mosaic=mosaic)
+    if field is not None:
+        names = [name for name, geometry in geometries]
+        if None in names or len(set(names)) < len(names):
+            print('Error: values of field must be present and unique.')
+            exit()
+    sr = get_projection(geometries[0][1].GetSpatialReference())
     if sr is None:
         print('Error: EPSG projection code missing from shape.')
         exit()
 
-    # process target
-    target = create_dataset(dtype=dtype,
-                            path=target_path,
-                            geometry=geometry,
-                            cellsize=cellsize,
-                            fillvalue=fillvalue)
-
-    # prepare
-    gdal.TermProgress_nocb(0)
-    index = Index(target, geometry)
-    no_data_value = target.GetRasterBand(1).GetNoDataValue()
+    # one band per frame
+    time = get_time(time=time, start=start, stop=stop)
+    if start is None:
+        bands = 1
+    else:
+        bands = count_frames(store=store,
+                             geometry=geometries[0][1],
+                             sr=sr,
+                             time=time,
+                             step=step)
 
-    # work
-    total = len(index)
-    for count, tile in enumerate(index, 1):
-        # get data
-        kwargs = {'sr': sr,
-                  'start': time,
-                  'width': tile.width,
-                  'height': tile.height,
-                  'geom': tile.polygon.ExportToWkt()}
-        data = store.get_data(**kwargs)
+    # process targets
+    if block_size is not None:
+        block_size, origin = get_layout(store=store,
+                                        cellsize=cellsize,
+                                        block_size=block_size)
+    elif field is not None:
+        block_size, origin = BLOCK_SIZE, (0, 0)
+    else:
+        origin = 0, 0
+    if dry_run:
+        # sparse targets in memory, only to build the indices
+        output_format, resume = 'gtiff', False
+        paths = ['/vsimem/lextract/{}.tif'.format(number)
+                 for number in range(len(geometries))]
+    elif field is None:
+        paths = [target_path]
+    else:
+        if not os.path.exists(target_path):
+            os.makedirs(target_path)
+        extension = {'gtiff': 'tif', 'npy': 'npy'}[output_format]
+        paths = [os.path.join(target_path, '{}.{}'.format(name, extension))
+                 for name, geometry in geometries]
+    targets = []
+    target_paths = []
+    existing = []
+    for path, (name, geometry) in zip(paths, geometries):
+        if cog:
+            path += '.tmp.tif'
+        target_paths.append(path)
+        existing.append(resume and os.path.exists(path))
+        if output_format == 'npy':
+            if resume and os.path.exists(path):
+                targets.append(ArrayDataset(path))
+                continue
+            create = ArrayDataset.create
+        else:
+            if resume and os.path.exists(path):
+                targets.append(gdal.Open(str(path), gdal.GA_Update))
+                continue
+            create = create_dataset
+        targets.append(create(dtype=dtype,
+                              path=path,
+                              geometry=geometry,
+                              cellsize=cellsize,
+                              fillvalue=fillvalue,
+                              bands=bands,
+                              block_size=block_size,
+                              origin=origin))
 
-        # make source
-        array = data['values']
-        kwargs = {'projection': osr.GetUserInputAsWKT(str(sr)),
-                  'geo_transform': tile.geo_transform,
-                  'no_data_value': no_data_value}
+    # prepare
+    indices = [Index(target, geometry)
+               for target, (name, geometry) in zip(targets, geometries)]
+    if len(indices) == 1 and not dry_run:
+        # stream the blocks of a single target straight from its index
+        written = []
+        if existing[0] and output_format == 'gtiff':
+            path = target_paths[0]
+        else:
+            path = None  # nothing written yet, or no block offsets
+        blocks = iter_blocks(index=indices[0], path=path, written=written)
+    else:
+        # merge the blocks of targets that share a grid
+        blocks, written = get_blocks(indices=indices,
+                                     targets=targets if resume else None)
+    factors = []
+    for target in targets:
+        factors.append(get_factors(target) if cog else [])
+        overview_count = target.GetRasterBand(1).GetOverviewCount()
+        if factors[-1] and not overview_count:
+            target.BuildOverviews(str('NONE'), factors[-1])
+    no_data_value = targets[0].GetRasterBand(1).GetNoDataValue()
+    fetcher = Fetcher(store_path=store_path,
+                      sr=sr,
+                      time=time,
+                      step=step,
+                      no_data_value=no_data_value,
+                      factors=factors,
+                      resampling=resampling)
+    if queue_depth is None:
+        queue_depth = 2 * threads
 
-        with datasets.Dataset(array, **kwargs) as source:
+    if dry_run:
+        estimate(blocks=blocks,
+                 fetcher=fetcher,
+                 targets=targets,
+                 output_format=requested_format,
+                 threads=threads,
+                 queue_depth=queue_depth)
+        del targets[:]
+        for path in target_paths:
+            gdal.Unlink(str(path))
+        return
 
-            # set pixels outside geometry to 'no data'
-            outside = tile.polygon.Difference(geometry)
-            burn(dataset=source, geometry=outside, value=no_data_value)
+    # fetch ahead in threads, write in this thread
+    semaphore = threading.Semaphore(queue_depth)
+    stopped = threading.Event()
+    flush = Flusher(datasets=targets)
+    pool = ThreadPool(threads)
+    try:
+        tiles = get_tiles(blocks=blocks,
+                          semaphore=semaphore,
+                          stopped=stopped)
+        results = pool.imap(fetcher, tiles)
+        if isinstance(blocks, list):
+            results = common.progress(results, total=len(blocks))
+        else:
+            results = track(results, index=indices[0])
+        for result in results:
+            for number, tile, array, overviews in result:
+                write(dataset=targets[number],
+                      tile=tile,
+                      array=array,
+                      factors=factors[number],
+                      overviews=overviews)
+            semaphore.release()
+            flush()
+        pool.close()
+    finally:
+        # unblock the generator, or terminate waits for it forever
+        stopped.set()
+        for _ in range(queue_depth):
+            semaphore.release()
+        pool.terminate()
+        pool.join()
 
-            # write to target
-            p1, q1 = tile.origin
-            DRIVER_GDAL_MEM.CreateCopy('', source)
-            target.WriteRaster(
+    # overviews of written blocks may not have been flushed
+    if written:
+        logger.info('Skipped %s written tiles.', len(written))
+    for number, tile in written:
+        if not factors[number]:
+            continue
+        p1, q1 = tile.origin
+        array = np.array([
+            targets[number].GetRasterBand(i + 1).ReadAsArray(
                 p1, q1, tile.width, tile.height,
-                source.ReadRaster(0, 0, tile.width, tile.height),
-            )
+            ) for i in range(bands)
+        ])
+        overviews = [downsample(array=array,
+                                factor=factor,
+                                no_data_value=no_data_value,
+                                resampling=resampling)
+                     for factor in factors[number]]
+        write(dataset=targets[number],
+              tile=tile,
+              array=array,
+              factors=factors[number],
+              overviews=overviews)
 
-        gdal.TermProgress_nocb(count / total)
+    if cog:
+        # close the intermediate targets before copying and removing them,
+        # including the last one that is still bound to the loop variable
+        del targets[:]
+        del target
+        for number, path in enumerate(paths):
+            finish(source_path=target_paths[number],
+                   path=path,
+                   block_size=indices[number].block_size)
 
 
 def get_parser():
@@ -284,6 +1042,54 @@ def get_parser():
     parser.add_argument('-t', '--time',
                         default=TIME, dest='time',
                         help='ISO-8601 time. Default: "{}"'.format(TIME))
+    parser.add_argument('-s', '--start',
+                        help=('ISO-8601 start of time series, written as a '
+                              'band per frame.'))
+    parser.add_argument('-e', '--stop',
+                        help='ISO-8601 stop of time series.')
+    parser.add_argument('-i', '--step',
+                        type=int,
+                        default=1,
+                        help='Use every step-th frame. Default: 1')
+    parser.add_argument('-f', '--field',
+                        help=('Extract all features into OUTPUT as directory, '
+                              'naming the targets by this field.'))
+    parser.add_argument('-m', '--mosaic',
+                        action='store_true',
+                        help='Extract all features into a single target.')
+    parser.add_argument('-o', '--format',
+                        choices=FORMATS,
+                        default='gtiff',
+                        dest='output_format',
+                        help='Format of targets. Default: gtiff')
+    parser.add_argument('-b', '--block-size',
+                        type=get_block_size,
+                        help=('Block size of targets like 512 or 512,256, or '
+                              '"auto" to match the chunks of the store.'))
+    parser.add_argument('--cog',
+                        action='store_true',
+                        help='Write cloud optimized GeoTIFFs with overviews.')
+    parser.add_argument('-r', '--resampling',
+                        choices=RESAMPLING,
+                        default='average',
+                        help='Resampling of overviews. Default: average')
+    parser.add_argument('--estimate',
+                        action='store_true',
+                        dest='dry_run',
+                        help=('Report tiles, bytes and expected runtime '
+                              'without extracting.'))
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help=('Resume an interrupted run, skipping blocks '
+                              'present in existing targets.'))
+    parser.add_argument('-n', '--threads',
+                        type=int,
+                        default=1,
+                        help='Amount of fetching threads. Default: 1')
+    parser.add_argument('-q', '--queue-depth',
+                        type=int,
+                        help=('Amount of tiles fetched ahead of the writer. '
+                              'Default: twice the amount of threads'))
     return parser
 
 
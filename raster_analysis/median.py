@@ -17,6 +17,10 @@ import numpy as np
 
 from raster_store import stores
 
+from raster_analysis import cache
+from raster_analysis import common
+from raster_analysis.statistics import Statistics
+
 DRIVER_OGR_SHAPE = ogr.GetDriverByName(b'ESRI Shapefile')
 
 logger = logging.getLogger(__name__)
@@ -41,14 +45,59 @@ def get_parser():
     parser.add_argument('error_path',
                         metavar='ERROR',
                         help='Path to errors shape')
+    parser.add_argument('-m', '--max-memory',
+                        type=float,
+                        help=('Fetch geometries larger than this amount of '
+                              'megabytes from the store in parts.'))
+    parser.add_argument('-r', '--tolerance',
+                        type=float,
+                        help=('Allow coarser resolutions up to this fraction '
+                              'of the size of large geometries.'))
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=1,
+                        help='Amount of parallel processes (default 1).')
+    parser.add_argument('-t', '--timeout',
+                        type=float,
+                        help=('Give up on features that take longer than '
+                              'this amount of seconds.'))
+    parser.add_argument('--max-tasks',
+                        type=int,
+                        help=('Replace worker processes after this amount '
+                              'of features.'))
+    parser.add_argument('--memory-limit',
+                        type=float,
+                        help=('Limit the memory of each worker process to '
+                              'this amount of megabytes.'))
+    parser.add_argument('--cache',
+                        default=cache.PATH,
+                        dest='cache_path',
+                        help=('Directory for cached results '
+                              '(default "{}").'.format(cache.PATH)))
+    parser.add_argument('--cache-size',
+                        type=float,
+                        default=cache.SIZE,
+                        help=('Maximum cache size in megabytes '
+                              '(default {}).'.format(cache.SIZE)))
+    parser.add_argument('--no-cache',
+                        action='store_true',
+                        help='Do not use cached results.')
+    parser.add_argument('--resume',
+                        action='store_true',
+                        help='Resume an interrupted run, appending to '
+                             'the target and errors.')
     return parser
 
 
-def compute(store, geometry):
+def compute(store, sizer, geometry, max_cells=None):
     """ Return median. """
-    x1, x2, y1, y2 = geometry.GetEnvelope()
-    width = int(round((x2 - x1) / 0.5))
-    height = int(round((y2 - y1) / 0.5))
+    width, height = sizer.get_size(geometry.GetEnvelope())
+    if max_cells is not None and width * height > max_cells:
+        return compute_windows(store=store,
+                               geometry=geometry,
+                               width=width,
+                               height=height,
+                               max_cells=max_cells)
     datadict = store.get_data_for_polygon(
         projection='epsg:28992',
         geometry=geometry,
@@ -62,55 +111,140 @@ def compute(store, geometry):
     return median
 
 
-def command(store_path, source_path, target_path, error_path):
+def compute_windows(store, geometry, width, height, max_cells):
+    """ Return median, fetching at most max_cells pixels per request. """
+    def request(rectangle, width, height):
+        """ Return data for rectangle. """
+        return store.get_data_for_polygon(
+            projection='epsg:28992',
+            geometry=rectangle,
+            height=height,
+            width=width,
+            select=None,
+        )
+
+    fetch = common.get_fetch(geometry=geometry, request=request)
+    windows = common.get_windows(envelope=geometry.GetEnvelope(),
+                                 width=width,
+                                 height=height,
+                                 cells=max_cells)
+    result = Statistics(['median']).compute_windows(fetch=fetch,
+                                                    windows=windows,
+                                                    limit=max_cells)
+    return result['median']
+
+
+class Worker(object):
+    """ Compute medians for fids, using the cache. """
+    def __init__(self, store_path, source_path, max_memory, tolerance,
+                 cache_path, cache_size):
+        self.store = stores.Store(store_path)
+        # keep the source, or the layer loses its datasource
+        self.source = common.Source(source_path)
+        self.layer = self.source.layer
+        self.sizer = common.Sizer(store=self.store, tolerance=tolerance)
+        if max_memory is None:
+            self.max_cells = None
+        else:
+            itemsize = np.dtype(self.store.dtype).itemsize
+            self.max_cells = int(max_memory * 2 ** 20 // itemsize)
+        if cache_path is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(path=cache_path, size=cache_size)
+            self.spec = {'command': 'median',
+                         'store': os.path.abspath(store_path),
+                         'version': cache.get_version(store_path),
+                         'cellsize': self.sizer.cellsize,
+                         'tolerance': tolerance}
+
+    def __call__(self, fid):
+        """ Return median for fid. """
+        geometry = common.get_geometry(self.layer, fid)
+        if self.cache is not None:
+            key = self.cache.get_key(geometry, **self.spec)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached['median']
+        median = float(compute(geometry=geometry,
+                               store=self.store,
+                               sizer=self.sizer,
+                               max_cells=self.max_cells))
+        if self.cache is not None:
+            self.cache.set(key, {'median': median})
+        return median
+
+
+def command(store_path, source_path, target_path, error_path,
+            max_memory, tolerance, jobs, timeout, max_tasks, memory_limit,
+            cache_path, cache_size, no_cache, resume):
     """ Calculate medians. """
-    store = stores.Store(store_path)
-
     # source datasource
     source_datasource = ogr.Open(source_path)
     source_layer = source_datasource[0]
 
     # target datasource
-    if os.path.exists(target_path):
-        DRIVER_OGR_SHAPE.DeleteDataSource(target_path)
-    target_datasource = DRIVER_OGR_SHAPE.CreateDataSource(target_path)
-    target_layer = target_datasource.CreateLayer(b'median')
-    target_layer.CreateField(ogr.FieldDefn(b'median', ogr.OFTReal))
+    if resume and os.path.exists(target_path):
+        target_datasource = ogr.Open(target_path, 1)
+        target_layer = target_datasource[0]
+    else:
+        if os.path.exists(target_path):
+            DRIVER_OGR_SHAPE.DeleteDataSource(target_path)
+        target_datasource = DRIVER_OGR_SHAPE.CreateDataSource(target_path)
+        target_layer = target_datasource.CreateLayer(b'median')
+        target_layer.CreateField(ogr.FieldDefn(b'median', ogr.OFTReal))
     target_layer_defn = target_layer.GetLayerDefn()
 
     # error datasource
-    if os.path.exists(error_path):
-        DRIVER_OGR_SHAPE.DeleteDataSource(error_path)
-    error_datasource = DRIVER_OGR_SHAPE.CreateDataSource(error_path)
-    error_layer = error_datasource.CreateLayer(b'median')
-    source_layer_defn = source_layer.GetLayerDefn()
-    for i in range(source_layer_defn.GetFieldCount()):
-        source_field_defn = source_layer_defn.GetFieldDefn(i)
-        error_layer.CreateField(source_field_defn)
-
-    # prepare for progress
-    total = source_layer.GetFeatureCount()
-    gdal.TermProgress_nocb(0)
-
-    for count, source_feature in enumerate(source_layer, 1):
-        source_geometry = source_feature.geometry()
-        try:
-            median = compute(geometry=source_geometry, store=store)
-        except Exception as e:
-            logger.exception(e)
+    if resume and os.path.exists(error_path):
+        error_datasource = ogr.Open(error_path, 1)
+        error_layer = error_datasource[0]
+    else:
+        if os.path.exists(error_path):
+            DRIVER_OGR_SHAPE.DeleteDataSource(error_path)
+        error_datasource = DRIVER_OGR_SHAPE.CreateDataSource(error_path)
+        error_layer = error_datasource.CreateLayer(b'median')
+        source_layer_defn = source_layer.GetLayerDefn()
+        for i in range(source_layer_defn.GetFieldCount()):
+            source_field_defn = source_layer_defn.GetFieldDefn(i)
+            error_layer.CreateField(source_field_defn)
+
+    checkpoint = common.Checkpoint(
+        path=target_path,
+        datasets=[target_datasource, error_datasource],
+        resume=resume,
+    )
+    fids = [fid for fid in range(source_layer.GetFeatureCount())
+            if fid not in checkpoint]
+
+    results = common.supervise(
+        factory=Worker,
+        kwargs={'store_path': store_path,
+                'source_path': source_path,
+                'max_memory': max_memory,
+                'tolerance': tolerance,
+                'cache_path': None if no_cache else cache_path,
+                'cache_size': cache_size},
+        items=fids,
+        jobs=jobs,
+        timeout=timeout,
+        max_tasks=max_tasks,
+        memory_limit=memory_limit,
+    )
+
+    for fid in common.progress(fids, total=len(fids)):
+        ok, median = next(results)
+        source_feature = source_layer[fid]
+        if not ok:
+            logger.error('Feature %s failed: %s', fid, median)
             error_layer.CreateFeature(source_feature)
-            gdal.TermProgress_nocb(count / total)
-            continue
-        if np.isnan(median):
-            gdal.TermProgress_nocb(count / total)
-            continue
-
-        target_feature = ogr.Feature(target_layer_defn)
-        target_feature[b'median'] = median
-        target_feature.SetGeometry(source_geometry)
-        target_layer.CreateFeature(target_feature)
-
-        gdal.TermProgress_nocb(count / total)
+        elif not np.isnan(median):
+            target_feature = ogr.Feature(target_layer_defn)
+            target_feature[b'median'] = median
+            target_feature.SetGeometry(source_feature.geometry())
+            target_layer.CreateFeature(target_feature)
+        checkpoint.add(fid)
+    checkpoint.commit()
 
 
 def main():
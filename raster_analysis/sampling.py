@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Sample rasters and raster stores at many points at once.
+
+Point coordinates are converted to pixel indices with a single matrix
+product and grouped by raster block, so that each block is read only once
+per batch of points. Blocks are kept in a cache of limited size and
+visited in Morton order, so that batches of nearby points can reuse the
+blocks of previous batches. Raster stores are sampled in the same way,
+using one store request per tile of the native grid of the store, if the
+grid and the spatial reference of the store are known.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import collections
+import os
+
+from osgeo import gdal_array
+from osgeo import gdal
+from osgeo import ogr
+from osgeo import osr
+import numpy as np
+
+from raster_store import load
+
+from raster_analysis import common
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+osr.UseExceptions()
+
+TILE = 256  # cells per side of the tiles of store requests
+POINT = str('POINT({} {})')
+
+BLOCK_CACHE = 256  # megabytes
+
+
+def spread(a):
+    """ Return array with bits of a moved to the even positions. """
+    a = a.astype('u8') & np.uint64(0xffffffff)
+    for shift, mask in ((16, 0x0000ffff0000ffff),
+                        (8, 0x00ff00ff00ff00ff),
+                        (4, 0x0f0f0f0f0f0f0f0f),
+                        (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        a = (a | (a << np.uint64(shift))) & np.uint64(mask)
+    return a
+
+
+def get_morton(u, v):
+    """ Return Morton codes for arrays of non-negative integers. """
+    return spread(u) | (spread(v) << np.uint64(1))
+
+
+def get_order(x, y):
+    """ Return indices that sort coordinates along a Morton curve. """
+    if not len(x):
+        return np.array([], dtype='i8')
+    scale = 2 ** 20 - 1
+    u = (x - x.min()) / max(np.ptp(x), 1e-12) * scale
+    v = (y - y.min()) / max(np.ptp(y), 1e-12) * scale
+    return np.argsort(get_morton(u, v), kind='mergesort')
+
+
+def sort_fids(layer, fids):
+    """ Return fids sorted along a Morton curve through their centroids. """
+    points = [common.get_geometry(layer, fid).Centroid().GetPoint_2D()
+              for fid in fids]
+    if not points:
+        return []
+    x, y = np.array(points, dtype='f8').T
+    return [fids[index] for index in get_order(x, y).tolist()]
+
+
+class BlockCache(object):
+    """ Least recently used blocks, up to a size in bytes. """
+    def __init__(self, read, size):
+        self.read = read
+        self.size = size
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.blocks = collections.OrderedDict()
+
+    def get(self, key):
+        """ Return block for key, reading it if not in cache. """
+        try:
+            array = self.blocks.pop(key)
+            self.hits += 1
+        except KeyError:
+            array = self.read(*key)
+            self.misses += 1
+            while self.blocks and self.used + array.nbytes > self.size:
+                self.used -= self.blocks.popitem(last=False)[1].nbytes
+            self.used += array.nbytes
+        self.blocks[key] = array
+        return array
+
+
+class GeoTransform(tuple):
+
+    def get_indices(self, x, y):
+        """
+        Return u, v arrays of pixel indices.
+
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+
+        Use the inverse of the transformation matrix to calculate
+        image coordinates for all points at once. Coordinates and geo
+        transform must be with respect to the same coordinate reference
+        system.
+        """
+        p, a, b, q, c, d = self
+        inverse = np.linalg.inv([(a, b), (c, d)])
+        u, v = np.floor(inverse.dot([x - p, y - q])).astype('i8')
+        return u, v
+
+
+def get_store_sr(store):
+    """ Return the spatial reference of a store, or None if unknown. """
+    projection = getattr(store, 'projection', None)
+    if not projection:
+        return None
+    sr = osr.SpatialReference()
+    try:
+        sr.SetFromUserInput(str(projection))
+    except RuntimeError:
+        return None
+    return sr
+
+
+def get_transformation(source, target):
+    """ Return coordinate transformation, or None if not needed. """
+    if source is None or source.IsSame(target):
+        return None
+    for sr in source, target:
+        if hasattr(sr, 'SetAxisMappingStrategy'):
+            sr.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return osr.CoordinateTransformation(source, target)
+
+
+class RasterSampler(object):
+    """ Sample the first band of a GDAL raster. """
+    def __init__(self, path, cache_size=BLOCK_CACHE):
+        self.dataset = gdal.Open(path)
+        self.geo_transform = GeoTransform(self.dataset.GetGeoTransform())
+        self.sr = osr.SpatialReference(self.dataset.GetProjection())
+        self.band = self.dataset.GetRasterBand(1)
+        self.block_size = self.band.GetBlockSize()
+        self.size = self.dataset.RasterXSize, self.dataset.RasterYSize
+        self.dtype = gdal_array.flip_code(self.band.DataType)
+        self.no_data_value = np.array(
+            self.band.GetNoDataValue(), self.dtype,
+        ).item()
+        self.cache = BlockCache(read=self._read,
+                                size=int(cache_size * 2 ** 20))
+
+    def _read(self, i, j):
+        """ Return array of block at column i and row j. """
+        w, h = self.block_size
+        W, H = self.size
+        xoff, yoff = i * w, j * h
+        return self.band.ReadAsArray(
+            xoff, yoff, min(w, W - xoff), min(h, H - yoff),
+        )
+
+    def sample(self, x, y):
+        """
+        Return list of values at coordinates, None where there is no data.
+
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+        """
+        return self.sample_indices(*self.geo_transform.get_indices(x, y))
+
+    def sample_indices(self, u, v):
+        """
+        Return list of values at pixel indices, None where there is no data.
+
+        :param u: array of column indices
+        :param v: array of row indices
+        """
+        w, h = self.block_size
+        W, H = self.size
+        inside = (u >= 0) & (u < W) & (v >= 0) & (v < H)
+        values = np.zeros(len(u), dtype=self.dtype)
+
+        # group points by block, in Morton order of the blocks
+        index = inside.nonzero()[0]
+        i, j = u[index] // w, v[index] // h
+        codes = get_morton(i, j)
+        order = np.argsort(codes, kind='mergesort')
+        index, i, j, codes = index[order], i[order], j[order], codes[order]
+        starts = np.unique(codes, return_index=True)[1]
+        stops = np.append(starts[1:], len(codes))
+
+        # get each block once
+        for start, stop in zip(starts, stops):
+            selection = index[start:stop]
+            block = i[start].item(), j[start].item()
+            xoff, yoff = block[0] * w, block[1] * h
+            array = self.cache.get(block)
+            values[selection] = array[v[selection] - yoff,
+                                      u[selection] - xoff]
+
+        active = inside & (values != self.no_data_value)
+        return [value if ok else None
+                for value, ok in zip(values.tolist(), active.tolist())]
+
+
+class StoreSampler(object):
+    """
+    Sample a raster store.
+
+    Points are grouped by tiles of the native grid of the store, and each
+    tile is fetched with a single request for the window that covers its
+    points, so that many points cost only a few store requests. The grid
+    is in the spatial reference of the store, so points are transformed to
+    it first. If the grid or the spatial reference of the store is not
+    known, each point is requested separately.
+    """
+    def __init__(self, store, sr):
+        self.store = store
+        self.sizer = common.Sizer(store)
+        self.sr = sr
+        self.store_sr = get_store_sr(store)
+        self.tiled = (self.store_sr is not None and
+                      getattr(store, 'geo_transform', None) is not None)
+        if self.tiled:
+            self.transformation = get_transformation(source=sr,
+                                                      target=self.store_sr)
+
+    def sample_points(self, x, y):
+        """ Return list of values, requesting each point separately. """
+        values = []
+        for point in zip(x.tolist(), y.tolist()):
+            geometry = ogr.CreateGeometryFromWkt(POINT.format(*point), self.sr)
+            data = self.store.get_data(geometry)
+            value = data['values'].ravel()[0].item()
+            values.append(None if value == data['no_data_value'] else value)
+        return values
+
+    def sample(self, x, y):
+        """
+        Return list of values at coordinates, None where there is no data.
+
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+
+        The coordinates must be in the spatial reference of the sampler.
+        """
+        if not self.tiled:
+            return self.sample_points(x, y)
+        values = [None] * len(x)
+        if not len(x):
+            return values
+        if self.transformation is not None:
+            points = self.transformation.TransformPoints(
+                np.column_stack([x, y]).tolist(),
+            )
+            x, y = np.array(points, dtype='f8')[:, :2].T
+        p, q = self.sizer.origin
+        a, d = self.sizer.cellsize
+        u = np.floor((x - p) / a).astype('i8')
+        v = np.floor((q - y) / d).astype('i8')
+
+        # group points by tile, in Morton order of the tiles
+        i, j = u // TILE, v // TILE
+        codes = get_morton(i - i.min(), j - j.min())
+        index = np.argsort(codes, kind='mergesort')
+        starts = np.unique(codes[index], return_index=True)[1]
+        stops = np.append(starts[1:], len(index))
+
+        # request the window around the points of each tile
+        for start, stop in zip(starts, stops):
+            selection = index[start:stop]
+            u1, u2 = u[selection].min(), u[selection].max() + 1
+            v1, v2 = v[selection].min(), v[selection].max() + 1
+            width, height = int(u2 - u1), int(v2 - v1)
+            polygon = common.POLYGON.format(
+                x1=p + a * u1, y1=q - d * v2, x2=p + a * u2, y2=q - d * v1,
+            )
+            geometry = ogr.CreateGeometryFromWkt(polygon, self.store_sr)
+            data = self.store.get_data(geometry, width=width, height=height)
+            array = data['values'].reshape(-1, height, width)[0]
+            sampled = array[v[selection] - v1, u[selection] - u1]
+            no_data_value = data['no_data_value']
+            for k, value in zip(selection.tolist(), sampled.tolist()):
+                values[k] = None if value == no_data_value else value
+        return values
+
+
+def get_sampler(path, sr, cache_size=BLOCK_CACHE):
+    """
+    Return sampler for the raster store or GDAL raster at path.
+
+    Raster stores are directories. The sr is used for store requests,
+    while rasters are sampled in their own spatial reference.
+    """
+    if os.path.isdir(path):
+        return StoreSampler(load(path), sr=sr)
+    return RasterSampler(path, cache_size=cache_size)
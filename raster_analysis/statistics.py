@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Plan a number of statistics up front and compute them together.
+
+All percentiles (including the median) share a single partition of the
+values, and statistics derived from the sum and count of the values
+share a single summation. Values are passed as plain arrays that have
+already been stripped of no data, so no masked arrays are involved.
+
+Values that do not fit in memory at once can be processed in windows,
+using mergeable accumulators for the moments, minimum and maximum and
+histogram refinement for exact percentiles.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import collections
+import logging
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+PATTERN = re.compile('(p)([0-9]+)')
+BINS = 1024  # histogram bins per refinement pass
+
+# statistics that are derived from the sum and the count of the values
+MOMENTS = 'sum', 'mean', 'var', 'std'
+
+
+def get_ranks(percentile, count):
+    """ Return lower rank, upper rank and interpolation weight. """
+    position = percentile / 100 * (count - 1)
+    lower = int(position)
+    upper = min(lower + 1, count - 1)
+    return lower, upper, position - lower
+
+
+class Accumulator(object):
+    """ Mergeable count, size, sum, variance, minimum and maximum. """
+    def __init__(self):
+        self.count = 0
+        self.size = 0
+        self.sum = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0  # sum of squared deviations from the mean
+        self.min = np.inf
+        self.max = -np.inf
+
+    def add(self, values, size):
+        """ Add 1D array of values with data and their amount of pixels. """
+        self.size += size
+        count = len(values)
+        if not count:
+            return
+        total = values.sum(dtype='f8')
+        mean = total / count
+        m2 = np.square(values - mean).sum(dtype='f8')
+
+        # combine with pairwise update for the variance
+        delta = mean - self.mean
+        combined = self.count + count
+        self.m2 += m2 + delta ** 2 * self.count * count / combined
+        self.mean += delta * count / combined
+        self.count = combined
+        self.sum += total
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+
+
+class Rank(object):
+    """
+    Find the value at a rank by narrowing down the range containing it.
+
+    Each pass over the values counts them in a histogram of the current
+    range, after which the range is narrowed to the bin containing the
+    rank. Once the bin is small enough its values are collected, sorted
+    and the value at the rank is taken.
+    """
+    def __init__(self, rank, lower, upper):
+        self.rank = rank  # relative to the values in range
+        self.lower = lower
+        self.upper = upper
+        self.closed = True  # whether upper is in range
+        self.collect = False
+        self.value = None
+        self._reset()
+
+    def _reset(self):
+        self.edges = np.linspace(self.lower, self.upper, BINS + 1)
+        self.counts = np.zeros(BINS, dtype='i8')
+        self.collected = []
+        self.min = np.inf
+        self.max = -np.inf
+
+    def overlaps(self, lower, upper):
+        """ Return if values between lower and upper could be in range. """
+        if upper < self.lower:
+            return False
+        return lower <= self.upper if self.closed else lower < self.upper
+
+    def add(self, values):
+        """ Add values of one window for this pass. """
+        if self.closed:
+            values = values[(values >= self.lower) & (values <= self.upper)]
+        else:
+            values = values[(values >= self.lower) & (values < self.upper)]
+        if not values.size:
+            return
+        self.min = min(self.min, values.min().item())
+        self.max = max(self.max, values.max().item())
+        if self.collect:
+            self.collected.append(values)
+            return
+        index = np.searchsorted(self.edges, values, side='right') - 1
+        index = np.minimum(index, BINS - 1)  # closed upper edge
+        self.counts += np.bincount(index, minlength=BINS)
+
+    def update(self, limit):
+        """ Narrow down after a pass. """
+        if self.collect:
+            values = np.sort(np.concatenate(self.collected))
+            self.value = values[self.rank].item()
+            return
+        if self.min == self.max:
+            # all values in range are the same
+            self.value = self.min
+            return
+
+        cumulative = np.cumsum(self.counts)
+        selected = np.searchsorted(cumulative, self.rank, side='right')
+        if selected:
+            self.rank -= cumulative[selected - 1].item()
+        lower = self.edges[selected].item()
+        upper = self.edges[selected + 1].item()
+        closed = self.closed and selected == BINS - 1
+        if (lower, upper, closed) == (self.lower, self.upper, self.closed):
+            # out of floating point resolution, just collect
+            self.collect = True
+        self.lower, self.upper, self.closed = lower, upper, closed
+        self.collect |= self.counts[selected] <= limit
+        self._reset()
+
+
+class Statistics(object):
+    """ Parse statistics like "median", "p90" or "myfield:count". """
+    def __init__(self, statistics):
+        self.actions = collections.OrderedDict()  # column: action, args
+        for statistic in statistics:
+            # allow for different column name
+            try:
+                column, statistic = statistic.split(':')
+            except ValueError:
+                column = statistic
+
+            # determine the action
+            match = PATTERN.match(statistic)
+            if match:
+                percentile = int(match.groups()[1])
+                if percentile > 100:
+                    logger.warning('Percentile of "%s" out of range, '
+                                   'writing nan.', column)
+                self.actions[column] = 'percentile', [percentile]
+            elif statistic == 'median':
+                self.actions[column] = 'percentile', [50]
+            else:
+                self.actions[column] = statistic, []
+
+        # plan the shared work
+        actions = [action for action, args in self.actions.values()]
+        self.percentiles = sorted(set(
+            args[0] for action, args in self.actions.values()
+            if action == 'percentile' and args[0] <= 100
+        ))
+        self.partition = bool(self.percentiles) or 'min' in actions or \
+            'max' in actions
+        self.moments = any(action in MOMENTS for action in actions)
+        self.scalable = not set(actions) & {'count', 'size', 'sum'}
+        self.windowed = set(actions) <= set(MOMENTS + (
+            'count', 'size', 'min', 'max', 'value', 'percentile',
+        ))
+
+    @property
+    def columns(self):
+        return list(self.actions)
+
+    def _get_partitioned(self, values):
+        """ Return values partitioned at all ranks of interest. """
+        count = len(values)
+        ranks = {0, count - 1}
+        for percentile in self.percentiles:
+            lower, upper, weight = get_ranks(percentile, count)
+            ranks.update((lower, upper))
+        return np.partition(values, sorted(ranks))
+
+    def compute(self, values, size):
+        """
+        Return dictionary of column values.
+
+        :param values: 1D array of values with data
+        :param size: total amount of pixels, with or without data
+        """
+        count = len(values)
+        result = {}
+
+        if count and self.partition:
+            partitioned = self._get_partitioned(values)
+        if count and self.moments:
+            total = values.sum(dtype='f8')
+            mean = total / count
+
+        for column, (action, args) in self.actions.items():
+            if action == 'count':
+                result[column] = count
+                continue
+            if action == 'size':
+                result[column] = size
+                continue
+            if not count or action == 'percentile' and args[0] > 100:
+                result[column] = np.nan
+                continue
+
+            if action == 'percentile':
+                lower, upper, weight = get_ranks(args[0], count)
+                lower, upper = partitioned[[lower, upper]].astype('f8')
+                value = lower + (upper - lower) * weight
+            elif action == 'min':
+                value = partitioned[0]
+            elif action == 'max':
+                value = partitioned[count - 1]
+            elif action == 'sum':
+                value = total
+            elif action == 'mean':
+                value = mean
+            elif action in ('var', 'std'):
+                value = np.square(values - mean).sum(dtype='f8') / count
+                if action == 'std':
+                    value = np.sqrt(value)
+            elif action == 'value':
+                value = values.item() if count == 1 else np.nan
+            else:
+                # anything else numpy offers, like 'ptp'
+                try:
+                    value = getattr(np, action)(values, *args)
+                except (ValueError, IndexError):
+                    value = np.nan
+            result[column] = float(value)
+
+        return result
+
+    def compute_zones(self, labels, values, sizes):
+        """
+        Return list of column value dictionaries, one per zone.
+
+        :param labels: 1D array of zero-based zone numbers for the values
+        :param values: 1D array of values with data
+        :param sizes: 1D array of total amount of pixels per zone
+
+        Values are sorted by zone and value once, after which all
+        statistics for all zones are derived from that single ordering.
+        """
+        zones = len(sizes)
+        order = np.lexsort((values, labels))
+        labels = labels[order]
+        values = values[order]
+        counts = np.bincount(labels, minlength=zones)
+        starts = np.cumsum(counts) - counts
+        found = counts > 0
+
+        def take(index):
+            """ Return values at index per zone, nan for empty zones. """
+            if not values.size:
+                return np.full(zones, np.nan)
+            index = np.where(found, index, 0)
+            return np.where(found, values[index], np.nan)
+
+        if self.moments:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                total = np.bincount(labels, weights=values, minlength=zones)
+                mean = total / counts
+
+        columns = {}
+        for column, (action, args) in self.actions.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                if action == 'count':
+                    columns[column] = counts
+                elif action == 'size':
+                    columns[column] = sizes
+                elif action == 'percentile' and args[0] > 100:
+                    columns[column] = np.full(zones, np.nan)
+                elif action == 'percentile':
+                    position = args[0] / 100 * (counts - 1)
+                    lower = np.floor(position).astype('i8')
+                    upper = np.minimum(lower + 1, counts - 1)
+                    lower, upper = take(starts + lower), take(starts + upper)
+                    columns[column] = lower + (upper - lower) * (
+                        position - np.floor(position)
+                    )
+                elif action == 'min':
+                    columns[column] = take(starts)
+                elif action == 'max':
+                    columns[column] = take(starts + counts - 1)
+                elif action == 'sum':
+                    columns[column] = np.where(found, total, np.nan)
+                elif action == 'mean':
+                    columns[column] = mean
+                elif action in ('var', 'std'):
+                    deviation = np.square(values - mean[labels])
+                    variance = np.bincount(
+                        labels, weights=deviation, minlength=zones,
+                    ) / counts
+                    columns[column] = (np.sqrt(variance)
+                                       if action == 'std' else variance)
+                elif action == 'value':
+                    columns[column] = np.where(
+                        counts == 1, take(starts), np.nan,
+                    )
+                else:
+                    # anything else numpy offers, like 'ptp'
+                    column_values = np.full(zones, np.nan)
+                    for zone in found.nonzero()[0]:
+                        start, stop = starts[zone], starts[zone] + counts[zone]
+                        try:
+                            column_values[zone] = getattr(np, action)(
+                                values[start:stop], *args
+                            )
+                        except (ValueError, IndexError):
+                            pass
+                    columns[column] = column_values
+
+        result = []
+        for zone in range(zones):
+            result.append({column: columns[column][zone].item()
+                           for column in columns})
+        return result
+
+    def compute_windows(self, fetch, windows, limit):
+        """
+        Return dictionary of column values, fetching values per window.
+
+        :param fetch: callable returning values, size tuple for a window
+        :param windows: sequence of windows to pass to fetch
+        :param limit: maximum amount of values to hold in memory
+
+        Values are fetched once to accumulate everything but the
+        percentiles. If all values fit within limit they are kept and the
+        statistics are computed as usual. Otherwise, windows are fetched
+        again to find each required percentile rank exactly, skipping
+        windows that cannot contain it.
+        """
+        accumulator = Accumulator()
+        ranges = []  # value range per window
+        kept = []
+        for window in windows:
+            values, size = fetch(window)
+            accumulator.add(values=values, size=size)
+            if values.size:
+                ranges.append((values.min(), values.max()))
+            else:
+                ranges.append(None)
+            if kept is not None and accumulator.count <= limit:
+                kept.append(values)
+            else:
+                kept = None
+
+        count = accumulator.count
+        if kept is not None:
+            values = np.concatenate(kept) if kept else np.array([])
+            return self.compute(values=values, size=accumulator.size)
+
+        if not self.windowed:
+            logger.warning('Not all statistics can be computed in windows.')
+
+        # percentile ranks by histogram refinement
+        ranks = {}
+        for percentile in self.percentiles:
+            lower, upper, weight = get_ranks(percentile, count)
+            for rank in lower, upper:
+                ranks[rank] = Rank(rank=rank,
+                                   lower=accumulator.min,
+                                   upper=accumulator.max)
+        pending = list(ranks.values())
+        while pending:
+            for window, window_range in zip(windows, ranges):
+                relevant = [rank for rank in pending
+                            if window_range and rank.overlaps(*window_range)]
+                if not relevant:
+                    continue
+                values, size = fetch(window)
+                for rank in relevant:
+                    rank.add(values)
+            for rank in pending:
+                rank.update(limit)
+            pending = [rank for rank in pending if rank.value is None]
+
+        result = {}
+        for column, (action, args) in self.actions.items():
+            if action == 'count':
+                result[column] = count
+                continue
+            if action == 'size':
+                result[column] = accumulator.size
+                continue
+            if not count or action == 'percentile' and args[0] > 100:
+                result[column] = np.nan
+                continue
+
+            if action == 'percentile':
+                lower, upper, weight = get_ranks(args[0], count)
+                lower, upper = ranks[lower].value, ranks[upper].value
+                value = lower + (upper - lower) * weight
+            elif action == 'min':
+                value = accumulator.min
+            elif action == 'max':
+                value = accumulator.max
+            elif action == 'sum':
+                value = accumulator.sum
+            elif action == 'mean':
+                value = accumulator.sum / count
+            elif action in ('var', 'std'):
+                value = accumulator.m2 / count
+                if action == 'std':
+                    value = np.sqrt(value)
+            elif action == 'value':
+                value = accumulator.min if count == 1 else np.nan
+            else:
+                value = np.nan
+            result[column] = float(value)
+
+        return result
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import time
+import unittest
+
+from raster_analysis import common
+
+
+class Worker(object):
+    """ Double items, or misbehave on request. """
+    def __init__(self, factor):
+        self.factor = factor
+
+    def __call__(self, item):
+        if item == 'sleep':
+            time.sleep(30)
+        if item == 'crash':
+            os._exit(1)
+        if item == 'raise':
+            raise ValueError('raised')
+        return item * self.factor
+
+
+class TestSupervise(unittest.TestCase):
+    def test_in_process(self):
+        results = list(common.supervise(factory=Worker,
+                                        kwargs={'factor': 2},
+                                        items=[1, 'raise', 3]))
+        self.assertEqual(results[0], (True, 2))
+        self.assertFalse(results[1][0])
+        self.assertIn('ValueError', results[1][1])
+        self.assertEqual(results[2], (True, 6))
+
+    def test_processes(self):
+        items = [1, 'sleep', 2, 'crash', 3, 'raise', 4, 5]
+        start = time.time()
+        results = list(common.supervise(factory=Worker,
+                                        kwargs={'factor': 2},
+                                        items=items,
+                                        jobs=2,
+                                        timeout=2,
+                                        max_tasks=2))
+        self.assertLess(time.time() - start, 20)
+
+        # results come back in the order of the items
+        self.assertEqual(len(results), len(items))
+        self.assertEqual([ok for ok, result in results],
+                         [True, False, True, False, True, False, True, True])
+        self.assertEqual([result for ok, result in results if ok],
+                         [2, 4, 6, 8, 10])
+        self.assertIn('Timed out', results[1][1])
+        self.assertIn('crashed', results[3][1])
+        self.assertIn('ValueError', results[5][1])
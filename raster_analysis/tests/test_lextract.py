@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from raster_analysis import lextract
+
+
+class Band(object):
+    def __init__(self, block_size):
+        self.block_size = block_size
+
+    def GetBlockSize(self):
+        return list(self.block_size)
+
+
+class Dataset(object):
+    """ Just enough of a tiled GeoTIFF for get_factors. """
+    def __init__(self, width, height, block_size):
+        self.RasterXSize = width
+        self.RasterYSize = height
+        self.band = Band(block_size)
+
+    def GetRasterBand(self, number):
+        return self.band
+
+
+class TestFactors(unittest.TestCase):
+    def test_square_blocks(self):
+        dataset = Dataset(width=3000, height=1000, block_size=(256, 256))
+        self.assertEqual(lextract.get_factors(dataset), [2, 4, 8, 16])
+
+    def test_small_dataset(self):
+        dataset = Dataset(width=200, height=100, block_size=(256, 256))
+        self.assertEqual(lextract.get_factors(dataset), [])
+
+    def test_factors_divide_blocks(self):
+        for block_size in (256, 48), (48, 256), (96, 96), (256, 1):
+            dataset = Dataset(width=100000,
+                              height=100000,
+                              block_size=block_size)
+            factors = lextract.get_factors(dataset)
+            for factor in factors:
+                self.assertEqual(block_size[0] % factor, 0)
+                self.assertEqual(block_size[1] % factor, 0)
+        dataset = Dataset(width=100000, height=100000, block_size=(256, 48))
+        self.assertEqual(lextract.get_factors(dataset), [2, 4, 8, 16])
+
+
+class TestDownsample(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.no_data_value = np.array(-9999, 'f4')
+        self.array = random.uniform(size=(2, 96, 144)).astype('f4')
+        self.array[:, ::5, ::3] = self.no_data_value
+
+    def test_blocks_line_up(self):
+        """ Reduced blocks must tile the reduced dataset. """
+        width, height = 48, 32
+        for factor in 2, 4, 8, 16:
+            for resampling in 'nearest', 'average', 'min', 'max':
+                kwargs = {'factor': factor,
+                          'no_data_value': self.no_data_value,
+                          'resampling': resampling}
+                expected = lextract.downsample(array=self.array, **kwargs)
+                rows = []
+                for v in range(0, 96, height):
+                    row = []
+                    for u in range(0, 144, width):
+                        block = self.array[:, v:v + height, u:u + width]
+                        reduced = lextract.downsample(array=block, **kwargs)
+                        self.assertEqual(
+                            reduced.shape,
+                            (2, height // factor, width // factor),
+                        )
+                        row.append(reduced)
+                    rows.append(np.concatenate(row, axis=2))
+                np.testing.assert_allclose(np.concatenate(rows, axis=1),
+                                           expected,
+                                           rtol=1e-6)
+
+    def test_no_data(self):
+        array = np.full((1, 4, 4), self.no_data_value, dtype='f4')
+        array[0, 0, 0] = 3
+        array[0, 1, 1] = 5
+        reduced = lextract.downsample(array=array,
+                                      factor=2,
+                                      no_data_value=self.no_data_value,
+                                      resampling='average')
+        self.assertEqual(reduced[0, 0, 0], 4)
+        self.assertEqual(reduced[0, 1, 1], self.no_data_value)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from raster_analysis import statistics
+
+STATISTICS = ['median', 'p10', 'p90', 'p100', 'min', 'max', 'mean', 'std',
+              'count', 'size']
+
+
+class TestStatistics(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.values = random.normal(size=10000).astype('f4')
+        self.values[::7] = self.values[3]  # some duplicates
+        self.statistics = statistics.Statistics(STATISTICS)
+
+    def assert_expected(self, result, values, size):
+        self.assertAlmostEqual(result['median'], np.median(values), 6)
+        for percentile in 10, 90, 100:
+            self.assertAlmostEqual(result['p{}'.format(percentile)],
+                                   np.percentile(values, percentile), 6)
+        self.assertAlmostEqual(result['min'], values.min(), 6)
+        self.assertAlmostEqual(result['max'], values.max(), 6)
+        self.assertAlmostEqual(result['mean'], values.mean(dtype='f8'), 6)
+        self.assertAlmostEqual(result['std'], values.std(dtype='f8'), 6)
+        self.assertEqual(result['count'], len(values))
+        self.assertEqual(result['size'], size)
+
+    def test_compute(self):
+        result = self.statistics.compute(values=self.values, size=12345)
+        self.assert_expected(result, values=self.values, size=12345)
+
+    def test_compute_windows(self):
+        windows = np.array_split(self.values, 10)
+        result = self.statistics.compute_windows(
+            fetch=lambda window: (window, window.size),
+            windows=windows,
+            limit=100,
+        )
+        self.assert_expected(result, values=self.values, size=10000)
+
+    def test_compute_zones(self):
+        labels = np.arange(len(self.values)) % 3
+        labels[labels == 2] = 3  # leave zone 2 empty
+        sizes = np.bincount(labels, minlength=4)
+        result = self.statistics.compute_zones(labels=labels,
+                                               values=self.values,
+                                               sizes=sizes)
+        for zone in 0, 1, 3:
+            values = self.values[labels == zone]
+            self.assert_expected(result[zone],
+                                 values=values,
+                                 size=len(values))
+        self.assertTrue(np.isnan(result[2]['median']))
+        self.assertEqual(result[2]['count'], 0)
+
+    def test_percentile_out_of_range(self):
+        planner = statistics.Statistics(['p150', 'median'])
+        result = planner.compute(values=self.values, size=10000)
+        self.assertTrue(np.isnan(result['p150']))
+        self.assertAlmostEqual(result['median'], np.median(self.values), 6)
+        result = planner.compute_zones(labels=np.zeros(10000, dtype='i8'),
+                                       values=self.values,
+                                       sizes=np.array([10000]))
+        self.assertTrue(np.isnan(result[0]['p150']))
@@ -2,6 +2,10 @@
 """
 Find lowest upstream points along a line within a polygon using
 combined data from raster stores.
+
+With the window option the stores are requested once per polygon, at
+their native resolution, and the search areas of all points are evaluated
+as masks on that window instead of requesting data for each point.
 """
 
 from __future__ import print_function
@@ -14,6 +18,7 @@ import math
 
 from osgeo import gdal
 from osgeo import ogr
+from scipy import ndimage
 import numpy as np
 
 from raster_store import load
@@ -81,10 +86,35 @@ def get_parser():
         metavar='',
         help='Separation between points (default 1.0)',
     )
+    parser.add_argument(
+        '-w', '--window',
+        action='store_true',
+        help=('Fetch raster data once per polygon and evaluate '
+              'the search areas on that window.'),
+    )
     parser.add_argument(
         '-p', '--partial',
         help='Partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        metavar='',
+        help='Amount of parallel processes (default 1).',
+    )
+    parser.add_argument(
+        '-c', '--chunk-size',
+        type=int,
+        default=1,
+        metavar='',
+        help='Amount of polygons per task for each process (default 1).',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume an interrupted run, appending to the output.',
+    )
     return parser
 
 
@@ -97,6 +127,15 @@ class MinimumStore(object):
     def __init__(self, paths):
         self.stores = [load(path) for path in paths]
 
+    @property
+    def geo_transform(self):
+        """ Return the geo transform of the finest store, if known. """
+        geo_transforms = [getattr(store, 'geo_transform', None)
+                          for store in self.stores]
+        if None in geo_transforms:
+            return None
+        return min(geo_transforms, key=lambda g: abs(g[1] * g[5]))
+
     def get_data(self, *args, **kwargs):
         data = [store.get_data(*args, **kwargs) for store in self.stores]
         array = np.ma.array(
@@ -108,14 +147,6 @@ class MinimumStore(object):
                 'values': array.min(0).filled(no_data_value)}
 
 
-def get_size(envelope):
-    """ Return width, height tuple based on ahn2 resolution. """
-    x1, x2, y1, y2 = envelope
-    width = int(math.ceil((x2 - x1) / 0.5))
-    height = int(math.ceil((y2 - y1) / 0.5))
-    return width, height
-
-
 def get_geotransform(size, envelope):
     """ Return appropriate geo-transform. """
     w, h = size
@@ -123,10 +154,127 @@ def get_geotransform(size, envelope):
     return x1, (x2 - x1) / w, 0, y2, 0, (y1 - y2) / h
 
 
+class Window(object):
+    """
+    Raster data for the envelope of a polygon at the native resolution.
+
+    Search areas are selected from this window with masks, so that the
+    stores are requested only once for all points within the polygon.
+    """
+    def __init__(self, store, polygon):
+        sizer = common.Sizer(store)
+        a, d = sizer.cellsize
+
+        # snap the envelope to the grid of the store
+        x1, y2, width, height = sizer.get_window(polygon.GetEnvelope())
+        width, height = max(1, width), max(1, height)
+        x2, y1 = x1 + a * width, y2 - d * height
+        geo_transform = x1, a, 0, y2, 0, -d
+
+        # get data from store
+        wkt = common.POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
+        rectangle = ogr.CreateGeometryFromWkt(
+            wkt, polygon.GetSpatialReference(),
+        )
+        data = store.get_data(geom=rectangle, width=width, height=height)
+        values = data['values'].reshape(-1, height, width)[0]
+
+        self.inside = common.get_mask(geometry=polygon,
+                                      geo_transform=geo_transform,
+                                      width=width,
+                                      height=height)
+        self.values = np.ma.masked_equal(values, data['no_data_value'])
+        self.cellsize = a, d
+        self.origin = x1, y2
+        self.shape = height, width
+
+        # coordinates of the cell centers
+        self.x = x1 + a * (np.arange(width) + 0.5)
+        self.y = y2 - d * (np.arange(height) + 0.5)
+
+        # distance from the cell centers to the polygon boundary, with a
+        # border of outside cells so that the window edge counts as well
+        border = np.pad(self.inside, 1, mode='constant')
+        transform = ndimage.distance_transform_edt(border, sampling=(d, a))
+        self.boundary = np.maximum(
+            0, transform[1:-1, 1:-1] - min(a, d) / 2,
+        )
+
+    def get_indices(self, points):
+        """ Return row, column index arrays, -1 outside the window. """
+        a, d = self.cellsize
+        p, q = self.origin
+        height, width = self.shape
+        u = np.floor((points[:, 0] - p) / a).astype('i8')
+        v = np.floor((q - points[:, 1]) / d).astype('i8')
+        outside = (u < 0) | (u >= width) | (v < 0) | (v >= height)
+        u[outside] = -1
+        v[outside] = -1
+        return v, u
+
+    def get_searches(self, points, distance, multiplier):
+        """
+        Return index and radius arrays for points within the polygon.
+
+        The radius is the distance to the polygon boundary times the
+        multiplier, but at least the distance.
+        """
+        v, u = self.get_indices(points)
+        index = ((v >= 0) & self.inside[v, u]).nonzero()[0]
+        boundary = self.boundary[v[index], u[index]]
+        return index, np.maximum(distance, multiplier * boundary)
+
+    def get_slices(self, x, y, radius):
+        """ Return row and column slices for cells within radius. """
+        a, d = self.cellsize
+        p, q = self.origin
+        height, width = self.shape
+        u1 = max(0, int(math.floor((x - radius - p) / a)))
+        u2 = min(width, int(math.ceil((x + radius - p) / a)))
+        v1 = max(0, int(math.floor((q - y - radius) / d)))
+        v2 = min(height, int(math.ceil((q - y + radius) / d)))
+        return slice(v1, v2), slice(u1, u2)
+
+    def get_level(self, point, direction, radius):
+        """
+        Return second lowest value in search area, or None.
+
+        The search area is the half of the circle around point ahead of
+        direction, within the polygon. Of an area in multiple parts, only
+        the part nearest to point is used.
+        """
+        x, y = point
+        rows, cols = self.get_slices(x=x, y=y, radius=radius)
+        dx = self.x[cols] - x
+        dy = self.y[rows, np.newaxis] - y
+        distance = dx ** 2 + dy ** 2
+        fx, fy = direction
+        area = np.logical_and.reduce([
+            distance <= radius ** 2,
+            dx * fx + dy * fy >= 0,
+            self.inside[rows, cols],
+        ])
+        if not area.any():
+            return
+
+        # keep only the part nearest to point
+        labels, count = ndimage.label(area)
+        if count > 1:
+            nearest = np.where(area, distance, np.inf).argmin()
+            area = labels == labels.flat[nearest]
+
+        array = self.values[rows, cols][area].compressed()
+        if array.size < 2:
+            return
+        return np.partition(array, 1)[1].item()
+
+
 class Case(object):
     def __init__(self, store, polygon, distance,
-                 multiplier, separation, linestring):
+                 multiplier, separation, linestring, window=None):
         self.store = store
+        self.sizer = common.Sizer(store)
+        self.window = window
         self.polygon = polygon
         self.distance = distance
         self.multiplier = multiplier
@@ -134,24 +282,30 @@ class Case(object):
         self.separation = separation
         self.sr = linestring.GetSpatialReference()
 
-    def get_pairs(self, reverse):
-        """ Return generator of point pairs. """
+    def get_points(self, reverse):
+        """ Return array of segmentized points. """
         linestring = self.linestring.Clone()
         linestring.Segmentize(self.separation)
-        points = linestring.GetPoints()
+        points = np.array(linestring.GetPoints(), dtype='f8')[:, :2]
         if reverse:
-            points.reverse()
-        return zip(points[:-1], points[1:])
+            points = points[::-1]
+        return points
 
     def get_sites(self, reverse):
-        """ Return generator of geometry, normal pairs. """
-        for (x1, y1), (x2, y2) in self.get_pairs(reverse):
-            dx, dy = x2 - x1, y2 - y1
-            l = math.sqrt(dx ** 2 + dy ** 2)
-            direction = dx / l, dy / l
-            yield point2geometry((x1, y1), self.sr), direction
-        # yield the last point with previous direction
-        yield point2geometry((x2, y2), self.sr), direction
+        """
+        Return points, directions arrays.
+
+        The direction of each point is the unit vector towards the next
+        point, the last point gets the direction of the previous one.
+        """
+        points = self.get_points(reverse)
+        if len(points) < 2:
+            return points[:0], points[:0]
+        vectors = np.diff(points, axis=0)
+        lengths = np.sqrt((vectors ** 2).sum(1))[:, np.newaxis]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            directions = vectors / lengths
+        return points, np.vstack([directions, directions[-1:]])
 
     def make_rectangle(self, point, radius, direction):
         """ Return ogr geometry of rectangle. """
@@ -177,15 +331,22 @@ class Case(object):
         wkt = 'POLYGON ((' + ','.join(points) + '))'
         return ogr.CreateGeometryFromWkt(wkt, sr)
 
-    def get_areas(self, reverse):
-        """ Return generator of point, area tuples. """
-        for point, direction in self.get_sites(reverse):
+    def get_searches(self, reverse):
+        """ Return generator of point, direction, radius tuples. """
+        boundary = self.polygon.Boundary()
+        for point, direction in zip(*self.get_sites(reverse)):
+            point = point2geometry(point.tolist(), self.sr)
             if not self.polygon.Contains(point):
                 continue
             radius = max(
                 self.distance,
-                self.multiplier * point.Distance(self.polygon.Boundary()),
+                self.multiplier * point.Distance(boundary),
             )
+            yield point, direction.tolist(), radius
+
+    def get_areas(self, reverse):
+        """ Return generator of point, area tuples. """
+        for point, direction, radius in self.get_searches(reverse):
             circle = point.Buffer(radius)
             rectangle = self.make_rectangle(point=point,
                                             radius=radius,
@@ -196,9 +357,30 @@ class Case(object):
 
     def get_levels(self, reverse):
         """ Return generator point, level tuples. """
+        if self.window is None:
+            return self.get_area_levels(reverse)
+        return self.get_window_levels(reverse)
+
+    def get_window_levels(self, reverse):
+        """ Return generator of point, level tuples using the window. """
+        points, directions = self.get_sites(reverse)
+        index, radii = self.window.get_searches(points=points,
+                                                distance=self.distance,
+                                                multiplier=self.multiplier)
+        for point, direction, radius in zip(points[index].tolist(),
+                                            directions[index].tolist(),
+                                            radii.tolist()):
+            level = self.window.get_level(point=point,
+                                          direction=direction,
+                                          radius=radius)
+            if level is not None:
+                yield point2geometry(point, self.sr), level
+
+    def get_area_levels(self, reverse):
+        """ Return generator of point, level tuples using store requests. """
         for point, polygon in self.get_areas(reverse):
             envelope = polygon.GetEnvelope()
-            width, height = get_size(envelope)
+            width, height = self.sizer.get_size(envelope)
 
             if polygon.GetGeometryName() == 'MULTIPOLYGON':
                 # keep reference to original collection or segfault
@@ -236,37 +418,45 @@ class Case(object):
                 continue
 
 
-def command(polygon_path, linestring_path, store_paths,
-            grow, distance, multiplier, separation, path, partial):
-    """ Main """
-    linestring_features = common.Source(linestring_path)
-    store = MinimumStore(store_paths)
-    target = common.Target(
-        path=path,
-        template_path=linestring_path,
-        attributes=[KEY],
-    )
-
-    # select some or all polygons
-    if partial is None:
-        polygon_features = common.Source(polygon_path)
-    else:
-        polygon_features = common.Source(polygon_path).select(partial)
+class Worker(object):
+    """ Find levels along the linestrings within polygons. """
+    def __init__(self, polygon_path, linestring_path, store_paths,
+                 grow, distance, multiplier, separation, window):
+        # keep the source, or the layer loses its datasource
+        self.polygon_source = common.Source(polygon_path)
+        self.polygon_layer = self.polygon_source.layer
+        self.linestring_features = common.Source(linestring_path)
+        self.store = MinimumStore(store_paths)
+        self.grow = grow
+        self.distance = distance
+        self.multiplier = multiplier
+        self.separation = separation
+        self.window = window
 
-    for polygon_feature in polygon_features:
+    def __call__(self, fid):
+        """ Return list of point wkb, attributes tuples for polygon fid. """
         # grow a little
-        polygon = polygon_feature.geometry().Buffer(grow)
+        geometry = common.get_geometry(self.polygon_layer, fid)
+        polygon = geometry.Buffer(self.grow)
 
         # query the linestrings
-        for linestring_feature in linestring_features.query(polygon):
+        linestring_features = list(self.linestring_features.query(polygon))
+        if self.window and linestring_features:
+            window = Window(store=self.store, polygon=polygon)
+        else:
+            window = None
+
+        records = []
+        for linestring_feature in linestring_features:
             linestring = linestring_feature.geometry()
 
-            case = Case(store=store,
+            case = Case(store=self.store,
                         polygon=polygon,
-                        distance=distance,
-                        multiplier=multiplier,
-                        separation=separation,
-                        linestring=linestring)
+                        distance=self.distance,
+                        multiplier=self.multiplier,
+                        separation=self.separation,
+                        linestring=linestring,
+                        window=window)
 
             # do
             try:
@@ -289,10 +479,53 @@ def command(polygon_path, linestring_path, store_paths,
                         continue
 
             # save
-            attributes = dict(linestring_feature.items())
             for point, level in zip(points, levels):
+                attributes = dict(linestring_feature.items())
                 attributes[KEY] = level
-                target.append(geometry=point, attributes=attributes)
+                records.append((point.ExportToWkb(), attributes))
+        return records
+
+
+def command(polygon_path, linestring_path, store_paths, grow, distance,
+            multiplier, separation, path, window, partial, jobs, chunk_size,
+            resume):
+    """ Main """
+    target = common.Target(
+        path=path,
+        template_path=linestring_path,
+        attributes=[KEY],
+        resume=resume,
+    )
+    checkpoint = common.Checkpoint(path=path,
+                                   datasets=[target.dataset],
+                                   resume=resume)
+
+    # select some or all polygons
+    fids = common.Source(polygon_path).get_fids(partial)
+    fids = [fid for fid in fids if fid not in checkpoint]
+
+    results = common.process(
+        factory=Worker,
+        kwargs={'polygon_path': polygon_path,
+                'linestring_path': linestring_path,
+                'store_paths': store_paths,
+                'grow': grow,
+                'distance': distance,
+                'multiplier': multiplier,
+                'separation': separation,
+                'window': window},
+        items=fids,
+        jobs=jobs,
+        chunk_size=chunk_size,
+    )
+    results = common.progress(results, total=len(fids))
+    for fid in fids:
+        records = next(results)
+        for wkb, attributes in records:
+            target.append(geometry=ogr.CreateGeometryFromWkb(wkb),
+                          attributes=attributes)
+        checkpoint.add(fid)
+    checkpoint.commit()
     return 0
 
 
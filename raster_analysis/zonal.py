@@ -7,6 +7,18 @@ with data), 'size' (the total amount of pixels) and 'p<n>' (the
 n-percentile). If the statistic is unsuitable as field name in the target
 shape, a different field name can be specified like "myfield:count"
 instead of simply "count".
+
+With the tile size option, polygons that fit in a tile are clustered by
+location and processed together from a single store request per cluster,
+which saves a lot of store round trips for many small adjacent polygons.
+
+Point features are sampled in groups, using a single store request per
+tile of the native grid of the store for all points in that tile.
+
+With a start (and optionally a stop) time, statistics are computed for all
+frames in the period from a single request per feature, for example for
+3Di results. Results are written as a feature per frame, or as a column per
+statistic and frame with the wide option.
 """
 
 from __future__ import print_function
@@ -16,8 +28,7 @@ from __future__ import division
 
 import argparse
 import logging
-import math
-import re
+import os
 import sys
 
 from osgeo import gdal
@@ -25,13 +36,18 @@ from osgeo import ogr
 import numpy as np
 
 from raster_store import load
+from raster_analysis import cache
 from raster_analysis import common
+from raster_analysis import sampling
+from raster_analysis.statistics import Statistics
 
 gdal.UseExceptions()
 ogr.UseExceptions()
 
 logger = logging.getLogger(__name__)
 
+POINTS = 4096  # amount of point features sampled together
+
 
 def get_parser():
     """ Return argument parser. """
@@ -63,83 +79,548 @@ def get_parser():
         '-p', '--partial',
         help='Partial processing source, for example "2/3"',
     )
+    parser.add_argument(
+        '-t', '--tile-size',
+        type=float,
+        help=('Process polygons smaller than this size in clusters '
+              'that share a single tile from the store.'),
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Amount of parallel processes (default 1).',
+    )
+    parser.add_argument(
+        '-c', '--chunk-size',
+        type=int,
+        default=16,
+        help='Amount of features per task for each process (default 16).',
+    )
+    parser.add_argument(
+        '-m', '--max-memory',
+        type=float,
+        help=('Fetch geometries larger than this amount of megabytes '
+              'from the store in parts.'),
+    )
+    parser.add_argument(
+        '-r', '--tolerance',
+        type=float,
+        help=('Allow coarser resolutions up to this fraction of the size '
+              'of large geometries, for example 0.01.'),
+    )
+    parser.add_argument(
+        '-s', '--start',
+        help='ISO-8601 start of time series, for example for 3Di results.',
+    )
+    parser.add_argument(
+        '-e', '--stop',
+        help='ISO-8601 stop of time series.',
+    )
+    parser.add_argument(
+        '-i', '--step',
+        type=int,
+        default=1,
+        help='Use every step-th frame of the time series (default 1).',
+    )
+    parser.add_argument(
+        '-w', '--wide',
+        action='store_true',
+        help=('Write a column per statistic and frame, named like '
+              '"median_3", instead of a feature per frame with a '
+              '"frame" column.'),
+    )
+    parser.add_argument(
+        '--cache',
+        default=cache.PATH,
+        dest='cache_path',
+        help='Directory for cached results (default "{}").'.format(
+            cache.PATH,
+        ),
+    )
+    parser.add_argument(
+        '--cache-size',
+        type=float,
+        default=cache.SIZE,
+        help='Maximum cache size in megabytes (default {}).'.format(
+            cache.SIZE,
+        ),
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Do not use cached results.',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume an interrupted run, appending to the target.',
+    )
     return parser
 
 
-def get_kwargs(geometry):
-    """ Return get_data_kwargs based on ahn2 resolution. """
-    name = geometry.GetGeometryName()
-    if name == 'POINT':
-        return {}
-    if name == 'LINESTRING':
-        size = int(math.ceil(geometry.Length() / 0.5))
-        return {'size': size}
-    if name == 'POLYGON':
-        x1, x2, y1, y2 = geometry.GetEnvelope()
-        width = int(math.ceil((x2 - x1) / 0.5))
-        height = int(math.ceil((y2 - y1) / 0.5))
-        return {'width': width, 'height': height}
+def compute_frames(statistics, data, labels, sizes, step):
+    """
+    Return per zone a list of statistics per frame.
 
+    :param data: get_data result with time as first axis of the values
+    :param labels: 1D array of one-based zone labels, 0 for no zone
+    :param sizes: 1D array of total amount of pixels per zone
+    :param step: use only every step-th frame
 
-def command(source_path, store_path, target_path, statistics, partial):
-    """ Main """
-    if partial is None:
-        source_features = common.Source(source_path)
+    Zone and frame are combined into a single label, so that all frames
+    are reduced at once.
+    """
+    values = data['values']
+    frames = values.reshape(len(values), -1)[::step]
+    count, pixels = frames.shape
+    zones = len(sizes)
+
+    zone = np.tile(labels.astype('i8') - 1, count)
+    frame = np.repeat(np.arange(count) * zones, pixels)
+    values = frames.ravel()
+    active = (zone >= 0) & (values != data['no_data_value'])
+    results = statistics.compute_zones(labels=(zone + frame)[active],
+                                       values=values[active],
+                                       sizes=np.tile(sizes, count))
+    return [results[index::zones] for index in range(zones)]
+
+
+def compute(store, sizer, statistics, geometry,
+            max_cells=None, time=None, step=1):
+    """
+    Return statistics for a single geometry, or a list of statistics per
+    frame if time is given as start and stop keyword arguments.
+    """
+    kwargs = sizer.get_kwargs(geometry)
+    if time is not None:
+        kwargs.update(time)
+        data = store.get_data(geometry, **kwargs)
+        pixels = data['values'][0].size
+        return compute_frames(statistics=statistics,
+                              data=data,
+                              labels=np.ones(pixels, dtype='u1'),
+                              sizes=np.array([pixels]),
+                              step=step)[0]
+
+    if max_cells is not None and 'width' in kwargs:
+        if kwargs['width'] * kwargs['height'] > max_cells:
+            return compute_windows(store=store,
+                                   statistics=statistics,
+                                   geometry=geometry,
+                                   max_cells=max_cells,
+                                   **kwargs)
+    data = store.get_data(geometry, **kwargs)
+    values = data['values']
+    active = values[values != data['no_data_value']]
+    return statistics.compute(values=active, size=values.size)
+
+
+def compute_windows(store, statistics, geometry, width, height, max_cells):
+    """
+    Return statistics for a single geometry, fetching at most max_cells
+    pixels per store request.
+
+    The windows follow the pixel grid of a single request for the
+    geometry, so that the statistics are the same.
+    """
+    def request(rectangle, width, height):
+        """ Return data for rectangle. """
+        return store.get_data(rectangle, width=width, height=height)
+
+    fetch = common.get_fetch(geometry=geometry, request=request)
+    windows = common.get_windows(envelope=geometry.GetEnvelope(),
+                                 width=width,
+                                 height=height,
+                                 cells=max_cells)
+    return statistics.compute_windows(fetch=fetch,
+                                      windows=windows,
+                                      limit=max_cells)
+
+
+class Batch(object):
+    """ A cluster of nearby features that share a store request. """
+    def __init__(self):
+        self.fids = []
+        self.envelopes = []
+
+    def add(self, fid, envelope):
+        self.fids.append(fid)
+        self.envelopes.append(envelope)
+
+    def select(self, fids):
+        """ Return new batch with only the features in fids. """
+        batch = Batch()
+        for fid, envelope in zip(self.fids, self.envelopes):
+            if fid in fids:
+                batch.add(fid=fid, envelope=envelope)
+        return batch
+
+    def get_envelope(self):
+        """ Return envelope of all features in batch. """
+        x1s, x2s, y1s, y2s = zip(*self.envelopes)
+        return min(x1s), max(x2s), min(y1s), max(y2s)
+
+
+class Points(object):
+    """ Point features that are sampled together. """
+    def __init__(self, fids):
+        self.fids = fids
+
+    def select(self, fids):
+        """ Return new points with only the features in fids. """
+        return Points([fid for fid in self.fids if fid in fids])
+
+
+def get_points(layer, fids, size):
+    """ Return list of points of at most size nearby features each. """
+    ordered = sampling.sort_fids(layer=layer, fids=fids)
+    return [Points(ordered[i:i + size]) for i in range(0, len(ordered), size)]
+
+
+def compute_points(sampler, statistics, layer, points, dtype):
+    """ Return dictionary of fid: statistics for points. """
+    coordinates = [common.get_geometry(layer, fid).GetPoint_2D()
+                   for fid in points.fids]
+    x, y = np.array(coordinates, dtype='f8').T
+    results = {}
+    for fid, value in zip(points.fids, sampler.sample(x, y)):
+        values = np.array([] if value is None else [value], dtype=dtype)
+        results[fid] = statistics.compute(values=values, size=1)
+    return results
+
+
+def get_batches(layer, fids, tile_size):
+    """
+    Return singles, batches tuple.
+
+    Polygons that fit in a tile are put in the batch for the tile that
+    contains the center of their envelope, other features are returned
+    as singles to be processed by themselves.
+    """
+    singles = []
+    batches = {}
+    for fid in fids:
+        geometry = common.get_geometry(layer, fid)
+        x1, x2, y1, y2 = envelope = geometry.GetEnvelope()
+        if any([geometry.GetGeometryName() != 'POLYGON',
+                x2 - x1 > tile_size,
+                y2 - y1 > tile_size]):
+            singles.append(fid)
+            continue
+        key = (int((x1 + x2) / 2 // tile_size),
+               int((y1 + y2) / 2 // tile_size))
+        batches.setdefault(key, Batch()).add(fid=fid, envelope=envelope)
+    return singles, list(batches.values())
+
+
+def compute_batch(store, sizer, statistics, layer, batch, time=None, step=1):
+    """
+    Return dictionary of fid: statistics for features in batch.
+
+    The features are rasterized into a label array covering the window
+    of the batch, so that the statistics of all features can be computed
+    from a single store request. Overlapping features can not be
+    represented in a label array, in which case the features of the batch
+    are processed by themselves. So are features that are too small or
+    thin to cover the center of any pixel of the window, which would
+    otherwise get no values at all.
+    """
+    x1, y2, width, height = sizer.get_window(batch.get_envelope())
+    a, d = sizer.cellsize
+    geo_transform = x1, a, 0, y2, 0, -d
+    sr = layer.GetSpatialRef()
+
+    # put labelled geometries in a temporary layer
+    datasource = common.DRIVER_OGR_MEMORY.CreateDataSource('')
+    label_layer = datasource.CreateLayer(str('labels'), sr)
+    label_layer.CreateField(ogr.FieldDefn(str('label'), ogr.OFTInteger))
+    layer_defn = label_layer.GetLayerDefn()
+    for label, fid in enumerate(batch.fids, 1):
+        feature = ogr.Feature(layer_defn)
+        feature.SetGeometry(common.get_geometry(layer, fid))
+        feature[str('label')] = label
+        label_layer.CreateFeature(feature)
+
+    kwargs = {'layer': label_layer,
+              'geo_transform': geo_transform,
+              'width': width,
+              'height': height}
+
+    def compute_single(fid):
+        """ Return statistics for fid by itself. """
+        return compute(store=store,
+                       sizer=sizer,
+                       statistics=statistics,
+                       geometry=common.get_geometry(layer, fid),
+                       time=time,
+                       step=step)
+
+    # fall back to separate requests if features overlap
+    coverage = common.rasterize(data_type=gdal.GDT_UInt16,
+                                burn_values=[1],
+                                options=['MERGE_ALG=ADD'], **kwargs)
+    if coverage.max() > 1:
+        logger.debug('Overlapping features, batch processed per feature.')
+        return {fid: compute_single(fid) for fid in batch.fids}
+
+    labels = common.rasterize(data_type=gdal.GDT_UInt32,
+                              options=['ATTRIBUTE=label'], **kwargs).ravel()
+    counts = np.bincount(labels, minlength=len(batch.fids) + 1)[1:]
+    missing = [fid for fid, count in zip(batch.fids, counts) if not count]
+
+    # retrieve raster data for the window
+    x2, y1 = x1 + width * a, y2 - height * d
+    wkt = common.POLYGON.format(x1=x1, y1=y1, x2=x2, y2=y2)
+    window = ogr.CreateGeometryFromWkt(wkt, sr)
+    kwargs = {'width': width, 'height': height}
+    if time is not None:
+        kwargs.update(time)
+    data = store.get_data(window, **kwargs)
+
+    # size is the amount of pixels in the envelope, as with single requests
+    sizes = np.array([np.prod(sizer.get_size(envelope))
+                      for envelope in batch.envelopes])
+
+    # compute statistics for all features at once
+    if time is not None:
+        results = compute_frames(statistics=statistics,
+                                 data=data,
+                                 labels=labels,
+                                 sizes=sizes,
+                                 step=step)
     else:
-        source_features = common.Source(source_path).select(partial)
-
-    store = load(store_path)
-
-    # prepare statistics gathering
-    actions = {}  # column_name: func_name, args
-    percentile = None
-    pattern = re.compile('(p)([0-9]+)')
-    for statistic in statistics:
-        # allow for different column name
-        try:
-            column, statistic = statistic.split(':')
-        except ValueError:
-            column = statistic
-
-        # determine the action
-        match = pattern.match(statistic)
-        if pattern.match(statistic):
-            percentile = int(match.groups()[1])
-            actions[column] = 'percentile', [percentile]
-        elif statistic == 'value':
-            actions[column] = 'item', []
+        values = data['values'].ravel()
+        active = (labels > 0) & (values != data['no_data_value'])
+        results = statistics.compute_zones(labels=labels[active] - 1,
+                                           values=values[active],
+                                           sizes=sizes)
+    results = dict(zip(batch.fids, results))
+
+    # features without pixels in the window get the envelope request
+    if missing:
+        logger.debug('%s features without pixels processed by themselves.',
+                     len(missing))
+    for fid in missing:
+        results[fid] = compute_single(fid)
+    return results
+
+
+def get_time(start, stop):
+    """ Return time keyword arguments for get_data, or None. """
+    if start is None:
+        return None
+    if stop is None:
+        return {'start': start}
+    return {'start': start, 'stop': stop}
+
+
+def count_frames(store, geometry, time, step):
+    """ Return the amount of frames a request for time would return. """
+    point = geometry.Centroid()
+    point.AssignSpatialReference(geometry.GetSpatialReference())
+    data = store.get_data(point, **time)
+    return len(range(0, len(data['values']), step))
+
+
+def get_records(result, time, wide):
+    """ Return list of attribute dictionaries to write for a result. """
+    if time is None:
+        return [result]
+    if wide:
+        record = {}
+        for frame, statistics in enumerate(result):
+            for column, value in statistics.items():
+                record['{}_{}'.format(column, frame)] = value
+        return [record]
+    return [dict(statistics, frame=frame)
+            for frame, statistics in enumerate(result)]
+
+
+class Worker(object):
+    """ Compute statistics for fids or batches of fids. """
+    def __init__(self, source_path, store_path, statistics, max_memory,
+                 tolerance, start, stop, step, tile_size, cache_path,
+                 cache_size):
+        # keep the source, or the layer loses its datasource
+        self.source = common.Source(source_path)
+        self.layer = self.source.layer
+        self.store = load(store_path)
+        self.statistics = Statistics(statistics)
+        if tolerance is not None and not self.statistics.scalable:
+            logger.warning('Tolerance ignored for resolution '
+                           'dependent statistics like count.')
+            tolerance = None
+        self.sizer = common.Sizer(store=self.store, tolerance=tolerance)
+        self.sampler = sampling.StoreSampler(store=self.store,
+                                             sr=self.layer.GetSpatialRef())
+        if max_memory is None:
+            self.max_cells = None
         else:
-            actions[column] = statistic, []
+            itemsize = np.dtype(self.store.dtype).itemsize
+            self.max_cells = int(max_memory * 2 ** 20 // itemsize)
+        self.time = get_time(start=start, stop=stop)
+        self.step = step
+
+        # everything besides the geometry that determines the result
+        if cache_path is None:
+            self.cache = None
+        else:
+            self.cache = cache.Cache(path=cache_path, size=cache_size)
+            self.spec = {'command': 'zonal',
+                         'store': os.path.abspath(store_path),
+                         'version': cache.get_version(store_path),
+                         'statistics': statistics,
+                         'cellsize': self.sizer.cellsize,
+                         'tolerance': tolerance,
+                         'time': self.time,
+                         'step': step,
+                         'tile_size': tile_size}
+
+    def compute(self, item):
+        """ Return dictionary of fid: statistics. """
+        if isinstance(item, Points):
+            return compute_points(sampler=self.sampler,
+                                  statistics=self.statistics,
+                                  layer=self.layer,
+                                  points=item,
+                                  dtype=self.store.dtype)
+        if isinstance(item, Batch):
+            return compute_batch(store=self.store,
+                                 sizer=self.sizer,
+                                 statistics=self.statistics,
+                                 layer=self.layer,
+                                 batch=item,
+                                 time=self.time,
+                                 step=self.step)
+        geometry = common.get_geometry(self.layer, item)
+        return {item: compute(store=self.store,
+                              sizer=self.sizer,
+                              statistics=self.statistics,
+                              geometry=geometry,
+                              max_cells=self.max_cells,
+                              time=self.time,
+                              step=self.step)}
+
+    def __call__(self, item):
+        """ Return dictionary of fid: statistics, using the cache. """
+        if self.cache is None:
+            return self.compute(item)
+
+        # lookup
+        grouped = isinstance(item, (Batch, Points))
+        fids = item.fids if grouped else [item]
+        keys = {}
+        results = {}
+        for fid in fids:
+            geometry = common.get_geometry(self.layer, fid)
+            keys[fid] = self.cache.get_key(geometry, **self.spec)
+        cached = self.cache.get_many(keys.values())
+        for fid in fids:
+            if keys[fid] in cached:
+                results[fid] = cached[keys[fid]]
+
+        # compute the rest
+        missing = [fid for fid in fids if fid not in results]
+        if not missing:
+            return results
+        if grouped:
+            item = item.select(missing)
+        computed = self.compute(item)
+        self.cache.set_many({keys[fid]: result
+                             for fid, result in computed.items()})
+        results.update(computed)
+        return results
+
+
+def command(source_path, store_path, target_path,
+            statistics, partial, tile_size, jobs, chunk_size,
+            max_memory, tolerance, start, stop, step, wide,
+            cache_path, cache_size, no_cache, resume):
+    """ Main """
+    source = common.Source(source_path)
+    fids = source.get_fids(partial)
+
+    # time series
+    time = get_time(start=start, stop=stop)
+    if time is not None and max_memory is not None:
+        print('Error: max memory is not supported for time series.')
+        return 1
+
+    columns = Statistics(statistics).columns
+    if time is None:
+        attributes = columns
+    elif wide:
+        geometry = common.get_geometry(source.layer, fids[0])
+        frames = count_frames(store=load(store_path),
+                              geometry=geometry,
+                              time=time,
+                              step=step)
+        attributes = ['{}_{}'.format(column, frame)
+                      for frame in range(frames) for column in columns]
+    else:
+        attributes = columns + ['frame']
 
     target = common.Target(
         path=target_path,
         template_path=source_path,
-        attributes=actions,
+        attributes=attributes,
+        resume=resume,
     )
+    checkpoint = common.Checkpoint(path=target_path,
+                                   datasets=[target.dataset],
+                                   resume=resume)
+    fids = [fid for fid in fids if fid not in checkpoint]
 
-    for source_feature in source_features:
-        # retrieve raster data
-        geometry = source_feature.geometry()
-        kwargs = get_kwargs(geometry)
-        data = store.get_data(geometry, **kwargs)
-        masked = np.ma.masked_equal(data['values'],
-                                    data['no_data_value'])
-        compressed = masked.compressed()
-
-        # apppend statistics
-        attributes = source_feature.items()
-        for column, (action, args) in actions.items():
-            try:
-                if hasattr(np.ma, action):
-                    value = getattr(np.ma, action)(masked, *args)
-                else:
-                    value = getattr(np, action)(compressed, *args)
-                value = np.nan if np.ma.is_masked(value) else value
-            except (ValueError, IndexError):
-                value = np.nan
-            attributes[column] = value
-
-        target.append(geometry=geometry, attributes=attributes)
+    # cluster features
+    geometry_type = ogr.GT_Flatten(source.layer.GetGeomType())
+    if geometry_type == ogr.wkbPoint and time is None:
+        items = get_points(layer=source.layer, fids=fids, size=POINTS)
+    elif tile_size is None:
+        items = fids
+    else:
+        singles, batches = get_batches(layer=source.layer,
+                                       fids=fids,
+                                       tile_size=tile_size)
+        items = singles + batches
+
+    results = common.process(
+        factory=Worker,
+        kwargs={'source_path': source_path,
+                'store_path': store_path,
+                'statistics': statistics,
+                'max_memory': max_memory,
+                'tolerance': tolerance,
+                'start': start,
+                'stop': stop,
+                'step': step,
+                'tile_size': tile_size,
+                'cache_path': None if no_cache else cache_path,
+                'cache_size': cache_size},
+        items=items,
+        jobs=jobs,
+        chunk_size=chunk_size,
+    )
+
+    # write in source order as soon as possible
+    pending = {}
+    remaining = iter(fids)
+    fid = next(remaining, None)
+    for result in common.progress(results, total=len(items)):
+        pending.update(result)
+        while fid in pending:
+            source_feature = source.layer[fid]
+            records = get_records(result=pending.pop(fid),
+                                  time=time,
+                                  wide=wide)
+            for record in records:
+                attributes = source_feature.items()
+                attributes.update(record)
+                target.append(geometry=source_feature.geometry(),
+                              attributes=attributes)
+            checkpoint.add(fid)
+            fid = next(remaining, None)
+    checkpoint.commit()
     return 0
 
 